@@ -0,0 +1,171 @@
+"""Password hashing and signed session tokens.
+
+Passwords are stored as scrypt hashes. scrypt is deliberately slow (tens of
+milliseconds of CPU), so `PasswordVerifier` runs it in a small thread pool
+behind a semaphore instead of on the event loop. A successful login gets an
+HMAC-signed token; `TokenAuthority.verify` checks it once and then serves
+it from a TTL/LRU cache, so location posts never touch a password hash.
+
+To hash a new password:  python auth.py hash <password>
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+
+class VerifierBusy(Exception):
+    """Too many password checks in progress; try again shortly."""
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def hash_password(password: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> str:
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    """Blocking; use PasswordVerifier from async code."""
+    try:
+        scheme, n, r, p, salt, digest = encoded.split("$")
+    except ValueError:
+        return False
+    if scheme != "scrypt":
+        return False
+    expected = _unb64(digest)
+    actual = hashlib.scrypt(password.encode(), salt=_unb64(salt), n=int(n), r=int(r), p=int(p),
+                            dklen=len(expected))
+    return hmac.compare_digest(actual, expected)
+
+
+class PasswordVerifier:
+    """Runs verify_password off the event loop.
+
+    At most `max_workers` hashes run at once and at most `max_pending` logins
+    are in progress (running or waiting for a thread). Past that, verify()
+    raises VerifierBusy at once, so a login storm can't queue unbounded work.
+    """
+
+    # Verified against when the user doesn't exist, so unknown ids take as
+    # long to reject as wrong passwords
+    DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pw-hash")
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def verify(self, password: str, encoded: Optional[str]) -> bool:
+        if self._slots.locked():
+            raise VerifierBusy("too many logins in progress")
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            ok = await loop.run_in_executor(self._pool, verify_password, password,
+                                            encoded or self.DUMMY_HASH)
+        return ok and encoded is not None
+
+
+class TokenAuthority:
+    """Issues and checks HMAC-SHA256 signed session tokens.
+
+    A token is `<base64 claims>.<base64 signature>`; claims carry `sub`,
+    `role`, `exp` and anything else passed to issue(). Verified tokens are
+    cached (LRU, at most `cache_size`, each for `cache_ttl` seconds or until
+    the token expires, whichever is sooner). Tokens are not revoked: a
+    driver's token stops working on logout because the bus no longer names
+    that driver.
+    """
+
+    def __init__(self, secret: bytes, lifetime: float = 12 * 3600,
+                 cache_size: int = 10000, cache_ttl: float = 300.0):
+        self.secret = secret
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _sign(self, body: str) -> str:
+        return _b64(hmac.new(self.secret, body.encode(), hashlib.sha256).digest())
+
+    def issue(self, sub: str, role: str, **claims) -> str:
+        payload = {"sub": sub, "role": role, "exp": int(time.time() + self.lifetime), **claims}
+        body = _b64(json.dumps(payload, separators=(",", ":")).encode())
+        return f"{body}.{self._sign(body)}"
+
+    def verify(self, token: str) -> Optional[dict]:
+        """Claims of a valid, unexpired token, else None."""
+        now = time.time()
+        hit = self._cache.get(token)
+        if hit is not None:
+            claims, valid_until = hit
+            if now < valid_until:
+                self._cache.move_to_end(token)
+                return claims
+            del self._cache[token]
+
+        if not token.isascii():
+            return None     # compare_digest only takes ASCII strings
+        body, _, sig = token.partition(".")
+        if not sig or not hmac.compare_digest(sig, self._sign(body)):
+            return None
+        try:
+            claims = json.loads(_unb64(body))
+        except ValueError:
+            return None
+        if claims.get("exp", 0) <= now:
+            return None
+
+        self._cache[token] = (claims, min(claims["exp"], now + self.cache_ttl))
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return claims
+
+
+def load_secret(data_dir: Optional[str]) -> bytes:
+    """SESSION_SECRET, else a key kept in data_dir so every worker (and the
+    next restart) signs with the same one, else a per-process random key."""
+    env = os.environ.get("SESSION_SECRET")
+    if env:
+        return env.encode()
+    if not data_dir:
+        return secrets.token_bytes(32)
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, "session.key")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another worker may still be writing it
+        for _ in range(50):
+            with open(path, "rb") as f:
+                key = f.read()
+            if len(key) == 32:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f"{path} is not a valid session key")
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "hash":
+        sys.exit("usage: python auth.py hash <password>")
+    print(hash_password(sys.argv[2]))
@@ -0,0 +1,165 @@
+"""In-process load test: simulated drivers and students against the ASGI app.
+
+Drives `main.app` through httpx's ASGI transport, so no server or network is
+involved and runs are reproducible (fixed seed). Drivers post a location
+every --driver-interval seconds; students poll GET /buses every
+--student-interval seconds with If-None-Match, and now and then ask for
+nearby buses or a stop ETA. Prints throughput and p50/p95/p99 latency per
+route, plus the event-loop lag seen by the app's /metrics.
+
+    python bench_load.py --drivers 200 --students 2000 --duration 20
+
+Needs the dev requirements (pip install -r requirements-dev.txt). Extra buses are registered for the run;
+their drivers get tokens directly instead of going through the scrypt
+login, so the numbers measure steady-state traffic.
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import time
+from collections import defaultdict
+
+import httpx
+
+# Keep the benchmark from writing a log in the working directory
+os.environ.setdefault("BUS_DATA_DIR", "")
+os.environ.setdefault("BUS_STORE", "memory")
+
+import main  # noqa: E402
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+async def pause(seconds, stop_at):
+    """Sleep, but never past the end of the run."""
+    await asyncio.sleep(max(0.0, min(seconds, stop_at - time.perf_counter())))
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def request(self, client, route, method, url, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            r = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(time.perf_counter() - t0)
+        if r.status_code >= 400:
+            self.errors[route] += 1
+        return r
+
+
+async def register_fleet(n, rng):
+    """Make sure there are n buses, each with a logged-in driver. Returns tokens."""
+    tokens = {}
+    campus_lat, campus_lng = 12.9716, 77.5946
+    for i in range(n):
+        bus_id = str(i + 1)
+        if bus_id not in main.buses:
+            main.buses[bus_id] = {
+                "lat": campus_lat + rng.uniform(-0.05, 0.05),
+                "lng": campus_lng + rng.uniform(-0.05, 0.05),
+                "name": f"Bench Bus {bus_id}", "status": "inactive",
+                "lastUpdate": None, "driver": None,
+            }
+        driver_id = f"bench-driver{bus_id}"
+        await main.store.update(bus_id, {"driver": driver_id, "status": "active"})
+        tokens[bus_id] = main.tokens.issue(driver_id, "driver", bus=bus_id)
+    return tokens
+
+
+async def driver(client, rec, bus_id, token, args, rng, stop_at):
+    headers = {"Authorization": f"Bearer {token}"}
+    bus = main.buses[bus_id]
+    lat, lng = bus["lat"], bus["lng"]
+    await pause(rng.uniform(0, args.driver_interval), stop_at)
+    while time.perf_counter() < stop_at:
+        lat += rng.gauss(0, 0.0002)
+        lng += rng.gauss(0, 0.0002)
+        await rec.request(client, "POST /buses/{bus_id}/location", "POST",
+                          f"/buses/{bus_id}/location", json={"lat": lat, "lng": lng}, headers=headers)
+        await pause(args.driver_interval, stop_at)
+
+
+async def student(client, rec, args, rng, stop_at):
+    etag = None
+    stop_ids = list(main.stops)
+    await pause(rng.uniform(0, args.student_interval), stop_at)
+    while time.perf_counter() < stop_at:
+        headers = {"If-None-Match": etag} if etag else {}
+        r = await rec.request(client, "GET /buses", "GET", "/buses", headers=headers)
+        if r is not None and r.status_code == 200:
+            etag = r.headers.get("etag")
+        roll = rng.random()
+        if roll < args.nearby_ratio:
+            await rec.request(client, "GET /buses/nearby", "GET", "/buses/nearby",
+                              params={"lat": 12.9716 + rng.uniform(-0.03, 0.03),
+                                      "lng": 77.5946 + rng.uniform(-0.03, 0.03)})
+        elif roll < args.nearby_ratio + args.eta_ratio:
+            await rec.request(client, "GET /stops/{stop_id}/eta", "GET",
+                              f"/stops/{rng.choice(stop_ids)}/eta")
+        await pause(args.student_interval, stop_at)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    rec = Recorder()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        tokens = await register_fleet(args.drivers, rng)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            stop_at = started + args.duration
+            tasks = [driver(client, rec, bus_id, token, args, random.Random(rng.random()), stop_at)
+                     for bus_id, token in tokens.items()]
+            tasks += [student(client, rec, args, random.Random(rng.random()), stop_at)
+                      for _ in range(args.students)]
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+            metrics_text = (await client.get("/metrics")).text
+
+    print(f"drivers={args.drivers} students={args.students} duration={elapsed:.1f}s seed={args.seed}")
+    print(f"{'route':32} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    total = 0
+    for route in sorted(rec.latencies):
+        values = sorted(rec.latencies[route])
+        total += len(values)
+        print(f"{route:32} {len(values):9d} {len(values) / elapsed:9.1f} "
+              f"{percentile(values, 0.50) * 1e3:8.2f} {percentile(values, 0.95) * 1e3:8.2f} "
+              f"{percentile(values, 0.99) * 1e3:8.2f} {rec.errors[route]:7d}")
+    print(f"{'total':32} {total:9d} {total / elapsed:9.1f}")
+
+    lag_sum = re.search(r"^event_loop_lag_seconds_sum\{[^}]*\} (\S+)$", metrics_text, re.M)
+    lag_count = re.search(r"^event_loop_lag_seconds_count\{[^}]*\} (\S+)$", metrics_text, re.M)
+    if lag_sum and lag_count and float(lag_count.group(1)):
+        print(f"mean event-loop lag: {float(lag_sum.group(1)) / float(lag_count.group(1)) * 1e3:.2f} ms")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--driver-interval", type=float, default=1.0)
+    parser.add_argument("--student-interval", type=float, default=3.0)
+    parser.add_argument("--nearby-ratio", type=float, default=0.1,
+                        help="share of student polls that also query /buses/nearby")
+    parser.add_argument("--eta-ratio", type=float, default=0.1,
+                        help="share of student polls that also query a stop ETA")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
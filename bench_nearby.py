@@ -0,0 +1,80 @@
+"""Benchmark GridIndex.nearest against a brute-force scan over all buses.
+
+    python bench_nearby.py --buses 5000 --queries 2000
+"""
+import argparse
+import math
+import random
+import time
+
+from spatial import GridIndex
+
+# A few campuses around Bangalore, roughly where the real buses run
+CAMPUSES = [(12.9716, 77.5946), (12.9352, 77.6245), (12.9876, 77.5512), (13.0827, 77.5800)]
+
+
+def brute_force(positions, lat, lng, radius_m, k):
+    r = 6371008.8
+    out = []
+    for bus_id, (blat, blng) in positions.items():
+        p1, p2 = math.radians(lat), math.radians(blat)
+        a = (math.sin((p2 - p1) / 2) ** 2
+             + math.cos(p1) * math.cos(p2) * math.sin(math.radians(blng - lng) / 2) ** 2)
+        d = 2 * r * math.asin(math.sqrt(min(a, 1.0)))
+        if d <= radius_m:
+            out.append((d, bus_id))
+    out.sort()
+    return [(bus_id, d) for d, bus_id in out[:k]]
+
+
+def random_point(rng):
+    lat, lng = rng.choice(CAMPUSES)
+    return lat + rng.gauss(0, 0.03), lng + rng.gauss(0, 0.03)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buses", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--radius", type=float, default=2000)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = GridIndex()
+    positions = {}
+    for i in range(args.buses):
+        lat, lng = random_point(rng)
+        positions[str(i)] = (lat, lng)
+        index.update(str(i), lat, lng)
+    queries = [random_point(rng) for _ in range(args.queries)]
+
+    # Moves: how expensive is keeping the index up to date
+    moves = [(str(rng.randrange(args.buses)), *random_point(rng)) for _ in range(args.queries)]
+    t0 = time.perf_counter()
+    for bus_id, lat, lng in moves:
+        index.update(bus_id, lat, lng)
+        positions[bus_id] = (lat, lng)
+    move_us = (time.perf_counter() - t0) / len(moves) * 1e6
+
+    t0 = time.perf_counter()
+    grid_results = [index.nearest(lat, lng, args.radius, args.k) for lat, lng in queries]
+    grid_us = (time.perf_counter() - t0) / len(queries) * 1e6
+
+    t0 = time.perf_counter()
+    brute_results = [brute_force(positions, lat, lng, args.radius, args.k) for lat, lng in queries]
+    brute_us = (time.perf_counter() - t0) / len(queries) * 1e6
+
+    mismatches = sum(
+        [b for b, _ in g] != [b for b, _ in f] for g, f in zip(grid_results, brute_results)
+    )
+    print(f"buses={args.buses} queries={args.queries} radius={args.radius:.0f}m k={args.k}")
+    print(f"index update : {move_us:9.2f} us/op")
+    print(f"grid nearest : {grid_us:9.2f} us/query")
+    print(f"brute force  : {brute_us:9.2f} us/query  ({brute_us / grid_us:.1f}x slower)")
+    print(f"mismatches   : {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Push channel for bus positions (Server-Sent Events).
+
+Instead of every client polling GET /buses, handlers call `publish()` and
+subscribers get one frame per changed bus per tick. Each bus is encoded once
+per tick no matter how many clients are listening.
+"""
+import asyncio
+import json
+from typing import Callable, Dict, Iterable, Optional, Set
+
+
+class Subscription:
+    """One connected client.
+
+    Pending frames are kept per bus, so a slow consumer only ever sees the
+    latest position of each bus - older frames for the same bus are dropped.
+    """
+
+    def __init__(self, bus_ids: Optional[Set[str]] = None, max_pending: int = 256):
+        self.bus_ids = bus_ids
+        self.max_pending = max_pending
+        self.pending: Dict[str, bytes] = {}
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def wants(self, bus_id: str) -> bool:
+        return self.bus_ids is None or bus_id in self.bus_ids
+
+    def push(self, bus_id: str, frame: bytes):
+        if bus_id in self.pending:
+            # Newer position replaces the one the client hasn't read yet
+            self.dropped += 1
+            del self.pending[bus_id]
+        elif len(self.pending) >= self.max_pending:
+            # Drop the stalest bus to stay bounded
+            self.pending.pop(next(iter(self.pending)))
+            self.dropped += 1
+        self.pending[bus_id] = frame
+        self._ready.set()
+
+    async def next_frames(self, timeout: Optional[float] = None) -> list:
+        """Wait for pending frames and drain them. Returns [] on timeout."""
+        if not self.pending:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        frames = list(self.pending.values())
+        self.pending.clear()
+        return frames
+
+
+class BusBroadcaster:
+    """Coalesces bus updates and fans them out to subscribers once per tick."""
+
+    def __init__(self, get_bus: Callable[[str], Optional[dict]], tick: float = 0.25):
+        self.get_bus = get_bus
+        self.tick = tick
+        self.subscribers: Set[Subscription] = set()
+        self._dirty: Set[str] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    @staticmethod
+    def encode(bus_id: str, bus: dict) -> bytes:
+        data = json.dumps({"id": bus_id, **bus}, separators=(",", ":"))
+        return f"event: bus\ndata: {data}\n\n".encode()
+
+    def subscribe(self, bus_ids: Optional[Iterable[str]] = None, max_pending: int = 256) -> Subscription:
+        sub = Subscription(set(bus_ids) if bus_ids is not None else None, max_pending)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        self.subscribers.discard(sub)
+
+    def publish(self, bus_id: str):
+        """Mark a bus as changed. Must be called from the event loop."""
+        if not self.subscribers:
+            return
+        self._dirty.add(bus_id)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.tick, self.flush)
+
+    def flush(self):
+        """Encode every dirty bus once and hand the frame to interested subscribers."""
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        for bus_id in dirty:
+            bus = self.get_bus(bus_id)
+            if bus is None:
+                continue
+            frame = None
+            for sub in self.subscribers:
+                if sub.wants(bus_id):
+                    if frame is None:
+                        frame = self.encode(bus_id, bus)
+                    sub.push(bus_id, frame)
+
+    async def stream(self, sub: Subscription, snapshot: Dict[str, dict], heartbeat: float = 15.0):
+        """Async generator of SSE bytes: an initial snapshot, then live frames."""
+        try:
+            for bus_id, bus in snapshot.items():
+                if sub.wants(bus_id):
+                    yield self.encode(bus_id, bus)
+            while True:
+                frames = await sub.next_frames(timeout=heartbeat)
+                if not frames:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield b": keep-alive\n\n"
+                    continue
+                yield b"".join(frames)
+        finally:
+            self.unsubscribe(sub)
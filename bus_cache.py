@@ -0,0 +1,81 @@
+"""Versioned, pre-encoded view of the `buses` dict for GET /buses.
+
+Versions come from the bus store: every mutation bumps a global version and
+stamps the changed bus with it. The JSON body is only re-encoded when the
+version has moved, and the version doubles as a strong ETag so idle polls
+can be answered with 304. Versions restart with the store, so a ?since
+token may carry the epoch too (the ETag value works as one).
+"""
+import json
+from typing import Dict, Optional, Tuple
+
+from store import BusStore
+
+
+def _opaque(tag: str) -> str:
+    """An entity tag without its weak prefix and quotes."""
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    return tag.strip('"')
+
+
+class BusSnapshotCache:
+    def __init__(self, store: BusStore):
+        self.store = store
+        self._body: Optional[bytes] = None
+        self._body_key = None
+
+    @property
+    def version(self) -> int:
+        return self.store.version
+
+    @property
+    def etag(self) -> str:
+        # Versions restart when the store does, so tag ETags with its epoch
+        return f'"{self.store.epoch}-{self.store.version}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """True if an If-None-Match header already names the current body.
+
+        Uses weak comparison (RFC 9110), so a W/ tag from a proxy that
+        compressed the response still matches.
+        """
+        if not if_none_match:
+            return False
+        current = _opaque(self.etag)
+        return any(t.strip() == "*" or _opaque(t) == current for t in if_none_match.split(","))
+
+    def body(self) -> Tuple[bytes, str]:
+        """Encoded JSON of all buses plus its ETag, rebuilt only on change."""
+        key = (self.store.epoch, self.store.version)
+        if self._body_key != key:
+            self._body = self.encode(self.store.buses)
+            self._body_key = key
+        return self._body, self.etag
+
+    def changed_since(self, since: str) -> Dict[str, dict]:
+        """Buses changed after a `since` token: "<version>" or "<epoch>-<version>".
+
+        A token from another epoch, or ahead of the current version, means
+        the store restarted since the client last polled, so everything is
+        returned. Raises ValueError for a malformed token.
+        """
+        epoch, sep, version = _opaque(since).rpartition("-")
+        if (sep and not epoch) or not (version.isascii() and version.isdigit()):
+            raise ValueError(f"invalid since token: {since!r}")
+        since_version = int(version)
+        if (epoch and epoch != self.store.epoch) or since_version > self.store.version:
+            return dict(self.store.buses)
+        if since_version == self.store.version:
+            return {}
+        buses = self.store.buses
+        return {
+            bus_id: buses[bus_id]
+            for bus_id, v in self.store.bus_versions.items()
+            if v > since_version and bus_id in buses
+        }
+
+    @staticmethod
+    def encode(data) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode()
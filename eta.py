@@ -0,0 +1,192 @@
+"""Route geometry, on-route projection and ETA prediction.
+
+Routes are polylines with an ordered list of stops. Everything that depends
+only on the route (segment lengths, cumulative distance, a grid of which
+segments pass through which cell, where each stop sits along the route) is
+computed once when the route is built. A location update then only looks at
+the segments near the bus, updates that bus's speed estimate and refreshes
+that bus's ETAs; reads just return the cached results.
+"""
+import math
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+METERS_PER_DEG_LAT = 111320.0
+
+DEFAULT_SPEED = 6.0     # m/s (~22 km/h) until we have observations
+MIN_SPEED = 1.5         # m/s; a parked bus still gets a finite ETA
+MAX_SPEED = 40.0        # m/s; faster than this is GPS noise
+SPEED_ALPHA = 0.3       # weight of the newest speed sample
+MAX_OFF_ROUTE = 300.0   # m; further than this and we don't trust the projection
+BACKTRACK = 20.0        # m; GPS jitter can put a bus this far behind its last position
+
+
+class Projection(NamedTuple):
+    along: float        # meters from the start of the route
+    offset: float       # meters from the bus to the route
+    segment: int
+
+
+class Route:
+    def __init__(self, route_id: str, path: Sequence[Tuple[float, float]],
+                 stops: Sequence[Tuple[str, float, float]], loop: bool = False,
+                 cell_m: float = 200.0):
+        if len(path) < 2:
+            raise ValueError(f"route {route_id} needs at least two points")
+        self.route_id = route_id
+        self.loop = loop
+        points = list(path)
+        if loop and points[0] != points[-1]:
+            points.append(points[0])
+
+        # Local equirectangular frame in meters, fine at city scale
+        self.lat0, self.lng0 = points[0]
+        self.kx = METERS_PER_DEG_LAT * math.cos(math.radians(self.lat0))
+        self.xy = [self.to_xy(lat, lng) for lat, lng in points]
+
+        self.cum = [0.0]
+        for (x1, y1), (x2, y2) in zip(self.xy, self.xy[1:]):
+            self.cum.append(self.cum[-1] + math.hypot(x2 - x1, y2 - y1))
+        self.length = self.cum[-1]
+
+        # Segment grid: cell -> segment indices whose bounding box touches it
+        self.cell_m = cell_m
+        self.grid: Dict[Tuple[int, int], List[int]] = {}
+        for i, ((x1, y1), (x2, y2)) in enumerate(zip(self.xy, self.xy[1:])):
+            for cx in range(self._c(min(x1, x2)), self._c(max(x1, x2)) + 1):
+                for cy in range(self._c(min(y1, y2)), self._c(max(y1, y2)) + 1):
+                    self.grid.setdefault((cx, cy), []).append(i)
+
+        # Ordered stops with their distance along the route; each is snapped
+        # going forward from the previous one, so a stop the route passes
+        # twice (out-and-back ends) lands on the right leg
+        self.stops: List[Tuple[str, float]] = []
+        along = 0.0
+        for stop_id, lat, lng in stops:
+            along = self.project(lat, lng, along).along
+            self.stops.append((stop_id, along))
+
+    def to_xy(self, lat: float, lng: float) -> Tuple[float, float]:
+        return (lng - self.lng0) * self.kx, (lat - self.lat0) * METERS_PER_DEG_LAT
+
+    def _c(self, v: float) -> int:
+        return math.floor(v / self.cell_m)
+
+    def _project_on(self, seg: int, x: float, y: float) -> Projection:
+        (x1, y1), (x2, y2) = self.xy[seg], self.xy[seg + 1]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = self.cum[seg + 1] - self.cum[seg]
+        t = 0.0 if seg_len == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / (seg_len * seg_len)))
+        px, py = x1 + t * dx, y1 + t * dy
+        return Projection(self.cum[seg] + t * seg_len, math.hypot(x - px, y - py), seg)
+
+    def forward(self, frm: float, to: float) -> float:
+        """Distance travelled going from `frm` to `to` along the route."""
+        d = to - frm
+        if self.loop and d < 0:
+            d += self.length
+        return d
+
+    def project(self, lat: float, lng: float, prev_along: Optional[float] = None) -> Projection:
+        """Snap a point onto the route.
+
+        Only segments in the 3x3 cells around the point are checked; the whole
+        polyline is scanned only if none are nearby. When several segments are
+        about equally close (out-and-back roads, loops), the one that is the
+        shortest step forward from prev_along wins; a step back is only taken
+        when there is no candidate ahead (or within BACKTRACK of) prev_along.
+        """
+        x, y = self.to_xy(lat, lng)
+        cx, cy = self._c(x), self._c(y)
+        segs = set()
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                segs.update(self.grid.get((cx + i, cy + j), ()))
+        if not segs:
+            segs = range(len(self.xy) - 1)
+
+        cands = [self._project_on(s, x, y) for s in segs]
+        best = min(cands, key=lambda p: p.offset)
+        if prev_along is None:
+            return best
+        close = [p for p in cands if p.offset <= best.offset + 15.0]
+        ahead = [p for p in close if self.forward(prev_along, p.along) >= -BACKTRACK]
+        if ahead:
+            return min(ahead, key=lambda p: self.forward(prev_along, p.along))
+        return max(close, key=lambda p: self.forward(prev_along, p.along))
+
+
+class BusProgress:
+    __slots__ = ("along", "ts", "speed", "off_route")
+
+    def __init__(self):
+        self.along: Optional[float] = None
+        self.ts: Optional[float] = None
+        self.speed = DEFAULT_SPEED
+        self.off_route = False
+
+
+class EtaEngine:
+    """Tracks each bus along its route and caches its ETAs per stop."""
+
+    def __init__(self, routes: Dict[str, Route], bus_routes: Dict[str, str]):
+        self.routes = routes
+        self.bus_routes = bus_routes
+        self.progress: Dict[str, BusProgress] = {}
+        # bus_id -> {stop_id: (arrival epoch, distance m)}, rebuilt only when that bus moves
+        self.cache: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        # stop_id -> buses whose route serves it
+        self.stop_buses: Dict[str, List[str]] = {}
+        for bus_id, route_id in bus_routes.items():
+            for stop_id, _ in routes[route_id].stops:
+                self.stop_buses.setdefault(stop_id, []).append(bus_id)
+
+    def observe(self, bus_id: str, ts: float, lat: float, lng: float):
+        """Feed one fix (in time order). Cheap; call refresh() after a batch."""
+        route_id = self.bus_routes.get(bus_id)
+        if route_id is None:
+            return
+        route = self.routes[route_id]
+        p = self.progress.setdefault(bus_id, BusProgress())
+        proj = route.project(lat, lng, p.along)
+        if proj.offset > MAX_OFF_ROUTE:
+            p.off_route = True
+            return
+        if p.along is not None and p.ts is not None and ts > p.ts and not p.off_route:
+            v = route.forward(p.along, proj.along) / (ts - p.ts)
+            if 0 <= v <= MAX_SPEED:
+                p.speed = SPEED_ALPHA * v + (1 - SPEED_ALPHA) * p.speed
+        p.along, p.ts, p.off_route = proj.along, ts, False
+
+    def refresh(self, bus_id: str, now: Optional[float] = None):
+        """Recompute the cached ETAs of one bus from its latest progress."""
+        p = self.progress.get(bus_id)
+        route_id = self.bus_routes.get(bus_id)
+        if p is None or route_id is None or p.along is None or p.off_route:
+            self.cache.pop(bus_id, None)
+            return
+        route = self.routes[route_id]
+        now = time.time() if now is None else now
+        speed = max(p.speed, MIN_SPEED)
+        etas = {}
+        for stop_id, stop_along in route.stops:
+            d = route.forward(p.along, stop_along)
+            if d < 0:
+                continue    # already passed on a one-way route
+            etas[stop_id] = (now + d / speed, d)
+        self.cache[bus_id] = etas
+
+    def clear(self, bus_id: str):
+        self.cache.pop(bus_id, None)
+        self.progress.pop(bus_id, None)
+
+    def bus_etas(self, bus_id: str) -> Dict[str, Tuple[float, float]]:
+        return self.cache.get(bus_id, {})
+
+    def stop_etas(self, stop_id: str) -> Dict[str, Tuple[float, float]]:
+        out = {}
+        for bus_id in self.stop_buses.get(stop_id, ()):
+            eta = self.cache.get(bus_id, {}).get(stop_id)
+            if eta is not None:
+                out[bus_id] = eta
+        return out
@@ -0,0 +1,160 @@
+"""Per-bus location history kept in fixed-size ring buffers.
+
+Each bus gets three parallel `array('d')` columns (timestamp, lat, lng),
+24 bytes per point. The columns start small and double as points arrive, up
+to a fixed capacity, after which they wrap around; a bus that reports
+rarely never pays for the full cap. Appends are amortised O(1); range
+lookups binary-search the timestamps, which are always increasing because
+only in-order fixes are appended.
+
+Configured from the environment by `create_history_store()`:
+    BUS_HISTORY_RETENTION           seconds of history to keep (default 12h)
+    BUS_HISTORY_MAX_BYTES_PER_BUS   memory cap per bus (default 1 MiB)
+"""
+import os
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+POINT_BYTES = 3 * array("d").itemsize
+INITIAL_POINTS = 64
+
+
+class BusTrack:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ts = array("d")
+        self.lat = array("d")
+        self.lng = array("d")
+        self.start = 0      # physical index of the oldest point
+        self.size = 0
+
+    def _phys(self, i: int) -> int:
+        return (self.start + i) % len(self.ts)
+
+    def _grow(self):
+        # Copy out in logical order, so the oldest point is at index 0 again
+        n = min(self.capacity, max(INITIAL_POINTS, 2 * len(self.ts)))
+        order = [self._phys(i) for i in range(self.size)]
+        pad = array("d", [0.0]) * (n - self.size)
+        self.ts = array("d", [self.ts[j] for j in order]) + pad
+        self.lat = array("d", [self.lat[j] for j in order]) + pad
+        self.lng = array("d", [self.lng[j] for j in order]) + pad
+        self.start = 0
+
+    def last_ts(self) -> Optional[float]:
+        return self.ts[self._phys(self.size - 1)] if self.size else None
+
+    def append(self, ts: float, lat: float, lng: float) -> bool:
+        """Add a point; returns False if it is not newer than the last one."""
+        last = self.last_ts()
+        if last is not None and ts <= last:
+            return False
+        if self.size == len(self.ts):
+            if self.size < self.capacity:
+                self._grow()
+            else:
+                # Full: overwrite the oldest point
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+        j = self._phys(self.size)
+        self.ts[j], self.lat[j], self.lng[j] = ts, lat, lng
+        self.size += 1
+        return True
+
+    def bisect(self, t: float, lo: int = 0, right: bool = False) -> int:
+        """Logical index of the first point with ts >= t (ts > t if right)."""
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self.ts[self._phys(mid)]
+            if v < t or (right and v == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def expire(self, cutoff: float):
+        """Drop points older than cutoff."""
+        n = self.bisect(cutoff)
+        if n:
+            self.start = self._phys(n)
+            self.size -= n
+
+    def point(self, i: int) -> Tuple[float, float, float]:
+        j = self._phys(i)
+        return self.ts[j], self.lat[j], self.lng[j]
+
+    def range(self, t_from: float, t_to: float, max_points: int) -> List[Tuple[float, float, float]]:
+        """Points with t_from <= ts <= t_to, decimated to at most max_points.
+
+        Decimation splits the range into equal time buckets and keeps the last
+        point of each, so the work is O(max_points * log n) however long the
+        range is. The first and last points of the range are always kept.
+        """
+        lo = self.bisect(t_from)
+        hi = self.bisect(t_to, lo, right=True)    # exclusive
+        n = hi - lo
+        if n <= max_points:
+            return [self.point(i) for i in range(lo, hi)]
+        if max_points < 2:
+            return [self.point(hi - 1)] if max_points == 1 else []
+
+        first_ts = self.ts[self._phys(lo)]
+        last_ts = self.ts[self._phys(hi - 1)]
+        buckets = max_points - 1
+        width = (last_ts - first_ts) / buckets
+        out = [self.point(lo)]
+        prev = lo
+        for b in range(1, buckets):
+            # Last point before the end of bucket b
+            idx = self.bisect(first_ts + width * b, prev + 1) - 1
+            if idx > prev:
+                out.append(self.point(idx))
+                prev = idx
+        out.append(self.point(hi - 1))
+        return out
+
+
+class HistoryStore:
+    """Location history for all buses.
+
+    retention: seconds of history to keep.
+    max_bytes_per_bus: memory cap per bus; sets the most points a bus's
+    ring buffer grows to.
+    """
+
+    def __init__(self, retention: float = 12 * 3600, max_bytes_per_bus: int = 1024 * 1024):
+        self.retention = retention
+        self.capacity = max(2, max_bytes_per_bus // POINT_BYTES)
+        self.tracks: Dict[str, BusTrack] = {}
+
+    def append(self, bus_id: str, ts: float, lat: float, lng: float) -> bool:
+        track = self.tracks.get(bus_id)
+        if track is None:
+            track = self.tracks[bus_id] = BusTrack(self.capacity)
+        added = track.append(ts, lat, lng)
+        cutoff = time.time() - self.retention
+        if track.size and track.ts[track.start] < cutoff:
+            track.expire(cutoff)
+        return added
+
+    def query(self, bus_id: str, t_from: Optional[float] = None, t_to: Optional[float] = None,
+              max_points: int = 500) -> List[Tuple[float, float, float]]:
+        track = self.tracks.get(bus_id)
+        if track is None:
+            return []
+        track.expire(time.time() - self.retention)
+        if t_from is None:
+            t_from = float("-inf")
+        if t_to is None:
+            t_to = float("inf")
+        return track.range(t_from, t_to, max_points)
+
+
+def create_history_store() -> HistoryStore:
+    """HistoryStore sized from BUS_HISTORY_RETENTION and BUS_HISTORY_MAX_BYTES_PER_BUS."""
+    return HistoryStore(
+        retention=float(os.environ.get("BUS_HISTORY_RETENTION", 12 * 3600)),
+        max_bytes_per_bus=int(os.environ.get("BUS_HISTORY_MAX_BYTES_PER_BUS", 1024 * 1024)),
+    )
@@ -0,0 +1,98 @@
+"""Parsing and ordering for batched location uploads.
+
+Drivers on flaky links buffer fixes and upload them in one request, either
+as a JSON array or as NDJSON (one fix object per line). Fixes are parsed by
+hand rather than through a pydantic model per fix, since batches can hold
+thousands of them.
+"""
+import json
+import math
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+MAX_BATCH_FIXES = 10000
+MAX_CLOCK_SKEW = 300.0      # seconds a fix may be ahead of the server clock
+
+
+class Fix(NamedTuple):
+    ts: float           # epoch seconds, used for ordering
+    bus_id: str
+    lat: float
+    lng: float
+    timestamp: str      # as sent by the driver, stored in lastUpdate
+
+
+def parse_timestamp(value) -> Optional[float]:
+    """ISO-8601 string or epoch seconds -> epoch seconds.
+
+    None for anything else, including NaN, infinities and epochs outside
+    what datetime can represent.
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            ts = float(value)
+            datetime.fromtimestamp(ts)      # range check
+            return ts
+        if isinstance(value, str):
+            return datetime.fromisoformat(value).timestamp()
+    except (ValueError, OverflowError, OSError):
+        return None
+    return None
+
+
+def _to_fix(item, default_bus_id: Optional[str], index: int) -> Fix:
+    if not isinstance(item, dict):
+        raise ValueError(f"fix {index}: expected an object")
+    bus_id = item.get("bus_id", default_bus_id)
+    if bus_id is None:
+        raise ValueError(f"fix {index}: missing bus_id")
+    lat, lng = item.get("lat"), item.get("lng")
+    for name, v in (("lat", lat), ("lng", lng)):
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v):
+            raise ValueError(f"fix {index}: {name} must be a number")
+    raw_ts = item.get("timestamp")
+    ts = parse_timestamp(raw_ts)
+    if ts is None:
+        raise ValueError(f"fix {index}: timestamp must be ISO-8601 or epoch seconds")
+    if not isinstance(raw_ts, str):
+        raw_ts = datetime.fromtimestamp(ts).isoformat()
+        ts = parse_timestamp(raw_ts)    # same rounding as lastUpdate read back elsewhere
+    return Fix(ts, str(bus_id), float(lat), float(lng), raw_ts)
+
+
+def parse_fixes(body: bytes, ndjson: bool = False, default_bus_id: Optional[str] = None) -> List[Fix]:
+    """Parse a JSON array or NDJSON body into fixes. Raises ValueError."""
+    try:
+        if ndjson:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(items, list):
+        raise ValueError("expected a JSON array of fixes")
+    if len(items) > MAX_BATCH_FIXES:
+        raise ValueError(f"too many fixes in one batch (max {MAX_BATCH_FIXES})")
+    return [_to_fix(item, default_bus_id, i) for i, item in enumerate(items)]
+
+
+def order_fixes(fixes: List[Fix], last_ts: Dict[str, float],
+                now: Optional[float] = None) -> Dict[str, List[Fix]]:
+    """Group fixes per bus in timestamp order, keeping only ones newer than
+    the last applied fix for that bus. Duplicates and stale fixes are dropped,
+    and so are fixes more than MAX_CLOCK_SKEW ahead of `now`, which would
+    otherwise block every later fix of that bus.
+    """
+    latest = (time.time() if now is None else now) + MAX_CLOCK_SKEW
+    per_bus: Dict[str, List[Fix]] = {}
+    for fix in sorted(fixes):
+        if fix.ts > latest:
+            break
+        newest = per_bus[fix.bus_id][-1].ts if fix.bus_id in per_bus else last_ts.get(fix.bus_id)
+        if newest is not None and fix.ts <= newest:
+            continue
+        per_bus.setdefault(fix.bus_id, []).append(fix)
+    return per_bus
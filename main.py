@@ -1,10 +1,36 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from datetime import datetime
+import time
 from pydantic import BaseModel
 from typing import Optional
 
-app = FastAPI(title="College Bus Tracker API")
+from auth import PasswordVerifier, TokenAuthority, VerifierBusy, load_secret
+from broadcast import BusBroadcaster
+from bus_cache import BusSnapshotCache
+from eta import EtaEngine, Route
+from history import create_history_store
+from ingest import Fix, order_fixes, parse_fixes, parse_timestamp
+from metrics import Metrics, MetricsMiddleware
+from persistence import create_durable_log
+from spatial import GridIndex
+from store import StoreUnavailable, create_store
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    metrics.start()
+    await store.start()
+    if durable_log is not None:
+        await durable_log.start(store)
+    yield
+    if durable_log is not None:
+        await durable_log.close()
+    await store.close()
+    metrics.stop()
+
+app = FastAPI(title="College Bus Tracker API", lifespan=lifespan)
 
 # ================== CORS ==================
 app.add_middleware(
@@ -18,8 +44,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Buses-Version"],
 )
 
+# ================== Metrics ==================
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
 # ================== Models ==================
 class LocationUpdate(BaseModel):
     lat: float
@@ -51,84 +82,441 @@ buses = {
           "lastUpdate": datetime.now().isoformat(), "driver": None}
 }
 
+# Passwords are scrypt hashes (same demo passwords as before: pass1, pass2, ...).
+# Make new ones with: python auth.py hash <password>
 drivers = {
-    "driver1": {"password": "pass1", "busId": "1", "name": "John Smith"},
-    "driver2": {"password": "pass2", "busId": "2", "name": "Maria Garcia"},
-    "driver3": {"password": "pass3", "busId": "3", "name": "Robert Johnson"},
-    "driver4": {"password": "pass4", "busId": "4", "name": "Sarah Wilson"}
+    "driver1": {"passwordHash": "scrypt$16384$8$1$iwmtpkisFOgDpOX4_HJdwA$yTvN3vN_xI6dp6vtz_-mZ42ZkaKBwk0ruIOxDVFoWAs",
+                "busId": "1", "name": "John Smith"},
+    "driver2": {"passwordHash": "scrypt$16384$8$1$bqxoCOzpzIaukfvLj3bNiA$VbowIyqJHgwoBs8O3Ss86AP3C4lIUKnZm2j0pqUgclw",
+                "busId": "2", "name": "Maria Garcia"},
+    "driver3": {"passwordHash": "scrypt$16384$8$1$odrvDX94GXjGnY8uY4QCvw$k-wN4KExthBe5zkgYFEWjjshPacsSYPA1q901yiNgHU",
+                "busId": "3", "name": "Robert Johnson"},
+    "driver4": {"passwordHash": "scrypt$16384$8$1$fGDK0ZtWlX4g9sAC7ilIuA$cYeAyyMlH2x1H6h9MsNalK67jbbl0GoYl2r9IaB5T1c",
+                "busId": "4", "name": "Sarah Wilson"}
 }
 
 students = {
-    "student1": {"password": "pass1", "name": "Alex Johnson"},
-    "student2": {"password": "pass2", "name": "Emma Davis"},
-    "student3": {"password": "pass3", "name": "Michael Brown"}
+    "student1": {"passwordHash": "scrypt$16384$8$1$6WGIU4Io7z9PZDwOBjz0tA$2v64KLNz_wB3G-HhM723Vt3OQ7zcR9RtA74bKWZIMfI",
+                 "name": "Alex Johnson"},
+    "student2": {"passwordHash": "scrypt$16384$8$1$NOfun6Sn2-5BlmrunTZAjQ$EXl3H2T15pdzlkhNBFPa_FPo99C2TqgnAL-rpWl5rDE",
+                 "name": "Emma Davis"},
+    "student3": {"passwordHash": "scrypt$16384$8$1$qyp1TYQbOE9D2M6hTxfbiQ$P8QHJFkD5-6ZGsi6BtEJAHbSV1hS0hTgaWL0WeabU2w",
+                 "name": "Michael Brown"}
+}
+
+stops = {
+    "campus-gate": {"name": "Campus Main Gate", "lat": 12.9716, "lng": 77.5946},
+    "library": {"name": "Central Library", "lat": 12.9650, "lng": 77.5860},
+    "north-hostel": {"name": "North Hostel", "lat": 12.9352, "lng": 77.6245},
+    "tech-park": {"name": "Tech Park", "lat": 12.9530, "lng": 77.6100},
+    "south-market": {"name": "South Market", "lat": 12.9876, "lng": 77.5512},
+    "stadium": {"name": "Stadium", "lat": 12.9790, "lng": 77.5720},
+    "east-depot": {"name": "East Depot", "lat": 12.9563, "lng": 77.5768}
+}
+
+# Route geometry per bus: polyline as [lat, lng] points plus stops in driving order
+bus_routes = {
+    "1": {"loop": True, "stops": ["campus-gate", "library"],
+          "path": [[12.9716, 77.5946], [12.9680, 77.5900], [12.9650, 77.5860],
+                   [12.9700, 77.5850], [12.9740, 77.5900]]},
+    "2": {"loop": False, "stops": ["north-hostel", "tech-park", "campus-gate"],
+          "path": [[12.9352, 77.6245], [12.9440, 77.6170], [12.9530, 77.6100],
+                   [12.9620, 77.6020], [12.9716, 77.5946]]},
+    "3": {"loop": False, "stops": ["south-market", "stadium", "campus-gate"],
+          "path": [[12.9876, 77.5512], [12.9830, 77.5620], [12.9790, 77.5720],
+                   [12.9750, 77.5840], [12.9716, 77.5946]]},
+    "4": {"loop": False, "stops": ["east-depot", "library", "campus-gate"],
+          "path": [[12.9563, 77.5768], [12.9610, 77.5830], [12.9650, 77.5860],
+                   [12.9716, 77.5946]]}
 }
 
+# ================== Shared State ==================
+# BUS_STORE=memory|shm|pubsub picks the backend; with shm or pubsub several
+# uvicorn workers see each other's updates. `buses` stays the local view.
+store = create_store(buses)
+
+async def save_bus(bus_id: str, fields: dict, fixes=()):
+    """Write bus fields (and the fixes behind them) through the store so every worker sees them."""
+    try:
+        await store.update(bus_id, fields, fixes)
+    except StoreUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+# ================== Change Tracking ==================
+broadcaster = BusBroadcaster(buses.get)
+bus_cache = BusSnapshotCache(store)
+nearby_index = GridIndex()
+for _bus_id, _bus in buses.items():
+    nearby_index.update(_bus_id, _bus['lat'], _bus['lng'])
+
+# Epoch timestamp of the newest fix applied per bus, used to drop stale batch fixes
+last_fix_ts = {}
+
+# ================== Location History ==================
+# Retention and per-bus memory cap come from BUS_HISTORY_* (see history.py)
+history = create_history_store()
+
+# ================== ETA ==================
+eta_engine = EtaEngine(
+    {
+        bus_id: Route(
+            bus_id,
+            [tuple(p) for p in r["path"]],
+            [(stop_id, stops[stop_id]["lat"], stops[stop_id]["lng"]) for stop_id in r["stops"]],
+            loop=r["loop"],
+        )
+        for bus_id, r in bus_routes.items()
+    },
+    {bus_id: bus_id for bus_id in bus_routes},
+)
+
+def eta_entry(arrival: float, distance: float, now: float) -> dict:
+    return {
+        "etaSeconds": max(0, round(arrival - now)),
+        "arrivalTime": datetime.fromtimestamp(arrival).isoformat(timespec="seconds"),
+        "distanceM": round(distance),
+    }
+
+def on_bus_changed(bus_id: str, version: int, remote: bool, fixes):
+    """Store listener: runs after every change to buses[bus_id], from any worker.
+
+    `fixes` are the (ts, lat, lng) points behind a location change, whichever
+    worker took them, so history and ETAs agree across workers.
+    """
+    bus = buses[bus_id]
+    nearby_index.update(bus_id, bus['lat'], bus['lng'])
+    broadcaster.publish(bus_id)
+    if bus['status'] != 'active':
+        eta_engine.clear(bus_id)
+        return
+    newest = last_fix_ts.get(bus_id, float("-inf"))
+    if not fixes:
+        # No points attached (login, recovered state). Only keep later fixes
+        # from going back past the stored position; shm may fold such a
+        # change into the next one, so adding it to history would differ
+        # between workers.
+        ts = parse_timestamp(bus['lastUpdate'])
+        if ts is not None and ts > newest:
+            last_fix_ts[bus_id] = ts
+        return
+    fresh = [f for f in fixes if f[0] > newest]
+    if not fresh:
+        return
+    last_fix_ts[bus_id] = fresh[-1][0]
+    for ts, lat, lng in fresh:
+        history.append(bus_id, ts, lat, lng)
+        eta_engine.observe(bus_id, ts, lat, lng)
+    eta_engine.refresh(bus_id)
+
+store.add_listener(on_bus_changed)
+
+# Snapshot + append-only log in BUS_DATA_DIR, so restarts keep positions and driver logins
+durable_log = create_durable_log()
+
+# ================== Auth ==================
+password_verifier = PasswordVerifier()
+# The signing key lives next to the log, so all workers and restarts share it
+tokens = TokenAuthority(load_secret(durable_log.data_dir if durable_log else None))
+
+async def check_password(password: str, encoded: Optional[str]) -> bool:
+    """Verify a password off the event loop; 503 while too many logins are in progress."""
+    try:
+        return await password_verifier.verify(password, encoded)
+    except VerifierBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+def authorize_driver(authorization: Optional[str], bus_id: str) -> dict:
+    """Check a driver's bearer token for acting on bus_id (locations, logout)."""
+    store.sync()    # the login may have gone to another worker
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing bearer token",
+                            headers={"WWW-Authenticate": "Bearer"})
+    claims = tokens.verify(token.strip())
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired token",
+                            headers={"WWW-Authenticate": "Bearer"})
+    if claims.get("role") != "driver" or claims.get("bus") != bus_id:
+        raise HTTPException(status_code=403, detail="Driver not assigned to this bus")
+    if buses[bus_id]['driver'] != claims["sub"]:
+        raise HTTPException(status_code=403, detail="Driver is not logged in on this bus")
+    return claims
+
+async def apply_fixes(bus_id: str, fixes: list):
+    """Apply an ordered run of fixes for one bus; only the newest lands in buses.
+
+    All of them go out with the change, and on_bus_changed feeds them to
+    history and ETAs on every worker, this one included.
+    """
+    newest = fixes[-1]
+    await save_bus(bus_id, {
+        'lat': newest.lat,
+        'lng': newest.lng,
+        'status': 'active',
+        'lastUpdate': newest.timestamp,
+    }, [(fix.ts, fix.lat, fix.lng) for fix in fixes])
+    metrics.count_bus_update(bus_id, len(fixes))
+
+async def ingest_batch(request: Request, default_bus_id: Optional[str] = None):
+    content_type = request.headers.get("content-type", "")
+    ndjson = "ndjson" in content_type or "jsonlines" in content_type
+    try:
+        fixes = parse_fixes(await request.body(), ndjson=ndjson, default_bus_id=default_bus_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    authorization = request.headers.get("authorization")
+    for bus_id in {f.bus_id for f in fixes if f.bus_id in buses}:
+        authorize_driver(authorization, bus_id)
+
+    unknown = [f for f in fixes if f.bus_id not in buses]
+    per_bus = order_fixes([f for f in fixes if f.bus_id in buses], last_fix_ts)
+    for bus_id, bus_fixes in per_bus.items():
+        await apply_fixes(bus_id, bus_fixes)
+
+    accepted = sum(len(v) for v in per_bus.values())
+    return {
+        "status": "success",
+        "accepted": accepted,
+        "ignored": len(fixes) - accepted - len(unknown),
+        "unknownBus": len(unknown),
+        "buses": {bus_id: buses[bus_id] for bus_id in per_bus},
+    }
+
 # ================== Routes ==================
 
 @app.get("/buses")
-async def get_buses():
-    """Return all buses with latest location and status."""
-    return buses
+async def get_buses(since: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    """Return all buses with latest location and status.
+
+    Supports If-None-Match (304 when nothing changed) and ?since=<version>
+    to get only the buses changed after that version. The current version
+    is sent in the X-Buses-Version header; passing the ETag value as since
+    also catches server restarts, which send the full state.
+    """
+    store.sync()
+    headers = {"X-Buses-Version": str(bus_cache.version)}
+    if since is not None:
+        try:
+            changed = bus_cache.changed_since(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid 'since' version")
+        body = bus_cache.encode(changed)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    if bus_cache.matches(if_none_match):
+        return Response(status_code=304, headers={**headers, "ETag": bus_cache.etag})
+    body, etag = bus_cache.body()
+    return Response(content=body, media_type="application/json", headers={**headers, "ETag": etag})
+
+@app.get("/buses/stream")
+async def stream_buses(bus_ids: Optional[str] = None):
+    """Server-Sent Events stream of bus positions.
+
+    Pass ?bus_ids=1,2 to only follow some buses. Sends the current state
+    first, then one event per changed bus per tick.
+    """
+    wanted = [b for b in bus_ids.split(",") if b] if bus_ids else None
+    sub = broadcaster.subscribe(wanted)
+    snapshot = {bus_id: dict(bus) for bus_id, bus in buses.items()}
+    return StreamingResponse(
+        broadcaster.stream(sub, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/buses/nearby")
+async def get_nearby_buses(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_m: float = Query(2000, gt=0, le=50000),
+    k: int = Query(5, ge=1, le=100),
+    include_inactive: bool = False,
+):
+    """Closest buses to a point, nearest first, with distance in meters."""
+    store.sync()
+    keep = None if include_inactive else (lambda bus_id: buses[bus_id]['status'] == 'active')
+    nearest = nearby_index.nearest(lat, lng, radius_m, k, keep)
+    return {
+        "buses": [
+            {"id": bus_id, "distanceM": round(dist, 1), **buses[bus_id]}
+            for bus_id, dist in nearest
+        ]
+    }
 
 @app.post("/buses/{bus_id}/location")
-async def update_bus_location(bus_id: str, location: LocationUpdate):
-    """Drivers send their current location to update the server."""
+async def update_bus_location(bus_id: str, location: LocationUpdate,
+                              authorization: Optional[str] = Header(None)):
+    """Drivers send their current location to update the server.
+
+    Needs the bearer token from /driver/login for this bus. A location
+    timestamped before the bus's last one is ignored.
+    """
     if bus_id not in buses:
         raise HTTPException(status_code=404, detail="Bus not found")
+    authorize_driver(authorization, bus_id)
     
-    buses[bus_id]['lat'] = location.lat
-    buses[bus_id]['lng'] = location.lng
-    buses[bus_id]['status'] = 'active'
-    buses[bus_id]['lastUpdate'] = location.timestamp or datetime.now().isoformat()
+    # ts is read back from the stored string, so it matches what other workers parse
+    timestamp = location.timestamp or datetime.now().isoformat()
+    fix = Fix(parse_timestamp(timestamp) or time.time(), bus_id, location.lat, location.lng, timestamp)
+    # Same rule as the batch endpoints: never roll a bus back or accept the future
+    if not order_fixes([fix], last_fix_ts):
+        return {"status": "ignored", "message": "Location is older than the last one or in the future",
+                "bus": buses[bus_id]}
+    await apply_fixes(bus_id, [fix])
     
     return {"status": "success", "message": "Location updated", "bus": buses[bus_id]}
 
+@app.post("/buses/locations/batch")
+async def update_locations_batch(request: Request):
+    """Upload many timestamped fixes for any buses in one request.
+
+    Body is a JSON array or NDJSON (Content-Type: application/x-ndjson) of
+    {"bus_id", "lat", "lng", "timestamp"} objects. Fixes are applied in
+    timestamp order; duplicates and fixes older than the bus's last known
+    position are ignored. Needs the driver's bearer token for every bus.
+    """
+    return await ingest_batch(request)
+
+@app.post("/buses/{bus_id}/location/batch")
+async def update_bus_location_batch(bus_id: str, request: Request):
+    """Same as /buses/locations/batch, but bus_id may be left out of each fix."""
+    if bus_id not in buses:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    return await ingest_batch(request, default_bus_id=bus_id)
+
+@app.get("/buses/{bus_id}/history")
+async def get_bus_history(
+    bus_id: str,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    max_points: int = Query(500, ge=1, le=5000),
+):
+    """Recent trail of a bus, thinned to at most max_points points.
+
+    from/to accept ISO-8601 timestamps or epoch seconds.
+    """
+    if bus_id not in buses:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    store.sync()
+    bounds = []
+    for name, value in (("from", from_), ("to", to)):
+        ts = None
+        if value is not None:
+            try:
+                ts = parse_timestamp(float(value))     # rejects nan/inf like fix timestamps
+            except ValueError:
+                ts = parse_timestamp(value)
+            if ts is None:
+                raise HTTPException(status_code=400, detail=f"Invalid '{name}' timestamp")
+        bounds.append(ts)
+
+    points = history.query(bus_id, bounds[0], bounds[1], max_points)
+    return {
+        "busId": bus_id,
+        "points": [
+            {"lat": lat, "lng": lng, "timestamp": datetime.fromtimestamp(ts).isoformat()}
+            for ts, lat, lng in points
+        ],
+    }
+
+@app.get("/buses/{bus_id}/eta")
+async def get_bus_eta(bus_id: str):
+    """Predicted arrival at each upcoming stop on this bus's route, soonest first."""
+    if bus_id not in buses:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    store.sync()
+    now = time.time()
+    etas = sorted(eta_engine.bus_etas(bus_id).items(), key=lambda item: item[1][0])
+    return {
+        "busId": bus_id,
+        "stops": [
+            {"stopId": stop_id, "name": stops[stop_id]["name"], **eta_entry(*eta, now)}
+            for stop_id, eta in etas
+        ],
+    }
+
+@app.get("/stops")
+async def get_stops():
+    """All stops with their location."""
+    return stops
+
+@app.get("/stops/{stop_id}/eta")
+async def get_stop_eta(stop_id: str):
+    """Predicted arrival of every tracked bus serving this stop, soonest first."""
+    if stop_id not in stops:
+        raise HTTPException(status_code=404, detail="Stop not found")
+    store.sync()
+    now = time.time()
+    etas = sorted(eta_engine.stop_etas(stop_id).items(), key=lambda item: item[1][0])
+    return {
+        "stopId": stop_id,
+        "name": stops[stop_id]["name"],
+        "buses": [
+            {"busId": bus_id, "name": buses[bus_id]["name"], **eta_entry(*eta, now)}
+            for bus_id, eta in etas
+        ],
+    }
+
 @app.post("/driver/login")
 async def login_driver(login_data: DriverLogin):
     """Driver login: assign driver to their bus."""
-    if login_data.driver_id not in drivers or drivers[login_data.driver_id]['password'] != login_data.password:
+    driver = drivers.get(login_data.driver_id)
+    if not await check_password(login_data.password, driver and driver['passwordHash']):
         raise HTTPException(status_code=401, detail="Invalid driver credentials")
     
     if drivers[login_data.driver_id]['busId'] != login_data.bus_id:
         raise HTTPException(status_code=403, detail="Driver not assigned to this bus")
         
-    buses[login_data.bus_id]['driver'] = login_data.driver_id
-    buses[login_data.bus_id]['status'] = 'active'
+    await save_bus(login_data.bus_id, {'driver': login_data.driver_id, 'status': 'active'})
     
     return {
         "status": "success", 
         "message": "Driver login successful", 
         "busId": login_data.bus_id,
-        "driverName": drivers[login_data.driver_id]['name']
+        "driverName": drivers[login_data.driver_id]['name'],
+        "token": tokens.issue(login_data.driver_id, "driver", bus=login_data.bus_id),
+        "tokenType": "bearer",
+        "expiresIn": int(tokens.lifetime)
     }
 
 @app.post("/driver/logout")
-async def logout_driver(logout_data: DriverLogout):
-    """Driver logout: release bus assignment."""
+async def logout_driver(logout_data: DriverLogout, authorization: Optional[str] = Header(None)):
+    """Driver logout: release bus assignment.
+
+    Needs the bearer token from /driver/login for this bus.
+    """
     if logout_data.bus_id not in buses:
         raise HTTPException(status_code=404, detail="Bus not found")
     
-    if buses[logout_data.bus_id]['driver'] != logout_data.driver_id:
+    claims = authorize_driver(authorization, logout_data.bus_id)
+    if claims["sub"] != logout_data.driver_id:
         raise HTTPException(status_code=400, detail="Driver not assigned to this bus")
     
-    buses[logout_data.bus_id]['driver'] = None
-    buses[logout_data.bus_id]['status'] = 'inactive'
+    await save_bus(logout_data.bus_id, {'driver': None, 'status': 'inactive'})
     
     return {"status": "success", "message": "Driver logged out successfully"}
 
 @app.post("/student/login")
 async def login_student(login_data: StudentLogin):
     """Student login."""
-    if login_data.student_id not in students or students[login_data.student_id]['password'] != login_data.password:
+    student = students.get(login_data.student_id)
+    if not await check_password(login_data.password, student and student['passwordHash']):
         raise HTTPException(status_code=401, detail="Invalid student credentials")
     
     return {
         "status": "success", 
         "message": "Student login successful",
-        "studentName": students[login_data.student_id]['name']
+        "studentName": students[login_data.student_id]['name'],
+        "token": tokens.issue(login_data.student_id, "student"),
+        "tokenType": "bearer",
+        "expiresIn": int(tokens.lifetime)
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for the worker that serves the request (see the pid label)."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
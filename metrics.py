@@ -0,0 +1,164 @@
+"""Request metrics in Prometheus text format.
+
+`MetricsMiddleware` is a plain ASGI middleware (no BaseHTTPMiddleware, so
+streaming responses are untouched) that times each request up to the start
+of its response and files it under the route template, e.g.
+/buses/{bus_id}/location, so label cardinality stays bounded. Histograms
+use fixed buckets: recording is one bisect and two additions.
+
+Metrics are kept per process. With several uvicorn workers a scrape of
+/metrics reaches whichever worker accepts it, so every series carries a
+`pid` label: each worker's counters stay separate series, to be combined
+with e.g. `sum without (pid) (rate(http_requests_total[5m]))`.
+"""
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        plain = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{plain} {self.sum}")
+        lines.append(f"{name}_count{plain} {self.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self, pid: Optional[int] = None):
+        self.pid = os.getpid() if pid is None else pid
+        self.started = time.time()
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        self.bus_updates: Dict[str, int] = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.loop_lag_last = 0.0
+        self._lag_task = None
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route)
+        hist = self.latency.get(key)
+        if hist is None:
+            hist = self.latency[key] = Histogram()
+        hist.observe(seconds)
+        rkey = (method, route, status)
+        self.requests[rkey] = self.requests.get(rkey, 0) + 1
+
+    def count_bus_update(self, bus_id: str, n: int = 1):
+        self.bus_updates[bus_id] = self.bus_updates.get(bus_id, 0) + n
+
+    async def _watch_loop_lag(self, interval: float):
+        # A sleep that wakes late means something hogged the event loop
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.perf_counter() - t0 - interval)
+            self.loop_lag_last = lag
+            self.loop_lag.observe(lag)
+
+    def start(self, interval: float = 0.25):
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(self._watch_loop_lag(interval))
+
+    def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    def render(self) -> str:
+        pid = f'pid="{self.pid}"'
+        out = [
+            "# HELP http_request_duration_seconds Time to first response byte, per route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), hist in sorted(self.latency.items()):
+            out += hist.render("http_request_duration_seconds",
+                               f'{pid},method="{method}",route="{_escape(route)}"')
+        out += [
+            "# HELP http_requests_total Requests by route and status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status), n in sorted(self.requests.items()):
+            out.append(f'http_requests_total{{{pid},method="{method}",route="{_escape(route)}",'
+                       f'status="{status}"}} {n}')
+        out += [
+            "# HELP bus_location_updates_total Location updates applied, per bus.",
+            "# TYPE bus_location_updates_total counter",
+        ]
+        for bus_id, n in sorted(self.bus_updates.items()):
+            out.append(f'bus_location_updates_total{{{pid},bus="{_escape(bus_id)}"}} {n}')
+        out += [
+            "# HELP event_loop_lag_seconds How late the event loop woke a sleeping task.",
+            "# TYPE event_loop_lag_seconds histogram",
+        ]
+        out += self.loop_lag.render("event_loop_lag_seconds", pid)
+        out += [
+            "# HELP event_loop_lag_last_seconds Most recent event loop lag sample.",
+            "# TYPE event_loop_lag_last_seconds gauge",
+            f"event_loop_lag_last_seconds{{{pid}}} {self.loop_lag_last}",
+            "# HELP process_start_time_seconds Start time of the process since unix epoch.",
+            "# TYPE process_start_time_seconds gauge",
+            f"process_start_time_seconds{{{pid}}} {self.started}",
+        ]
+        return "\n".join(out) + "\n"
+
+
+class MetricsMiddleware:
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        recorded = False
+
+        def record(status: int):
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            self.metrics.observe_request(scope["method"], path, status, time.perf_counter() - start)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and not recorded:
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if not recorded:
+                record(500)
+            raise
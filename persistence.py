@@ -0,0 +1,342 @@
+"""Durable bus state: append-only binary log, group commit and snapshots.
+
+Every change reported by the bus store is encoded into an in-memory buffer;
+a background task writes and fsyncs the buffer every `flush_interval`
+seconds, or sooner once `flush_records` records are waiting, so request
+handlers never wait on the disk. Every `snapshot_interval` seconds (or
+`snapshot_records` records) the full state is written to a snapshot and the
+log is started afresh. On startup the latest snapshot is loaded and the log
+tail replayed; for each bus the record with the highest version wins.
+
+Versions only compare within one store epoch. When the epoch changes (a
+restarted pub/sub hub numbers from 1 again) the log stops buffering and a
+snapshot of the new state replaces log and snapshot, so old, higher
+versions can't outrank it on recovery.
+
+Only one process per data directory writes (the one holding writer.lock).
+With several workers on the shm store that one worker sees every change
+through sync(), so it logs for all of them; if it dies another takes over.
+
+Files in data_dir:
+    snapshot.bin   latest snapshot, replaced atomically
+    wal.log        log since that snapshot (emptied once a snapshot is durable)
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from store import BusStore, Fixes
+
+logger = logging.getLogger(__name__)
+
+FRAME = struct.Struct("<II")          # payload length, crc32
+FIXED = struct.Struct("<Qdd")         # version, lat, lng
+SNAPSHOT_MAGIC = b"BUSSNAP1"
+SNAPSHOT_HEADER = struct.Struct("<8sQI")
+NO_VALUE = 0xFFFF
+
+Record = Tuple[int, dict]             # (version, fields)
+
+
+def _pack_str(value: Optional[str]) -> bytes:
+    if value is None:
+        return struct.pack("<H", NO_VALUE)
+    raw = value.encode()[:NO_VALUE - 1]
+    return struct.pack("<H", len(raw)) + raw
+
+
+def encode_record(bus_id: str, version: int, bus: dict) -> bytes:
+    payload = b"".join((
+        FIXED.pack(version, bus["lat"], bus["lng"]),
+        _pack_str(bus_id), _pack_str(bus.get("status")),
+        _pack_str(bus.get("lastUpdate")), _pack_str(bus.get("driver")),
+    ))
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload: bytes) -> Tuple[str, Record]:
+    version, lat, lng = FIXED.unpack_from(payload, 0)
+    pos = FIXED.size
+    strings = []
+    for _ in range(4):
+        (n,) = struct.unpack_from("<H", payload, pos)
+        pos += 2
+        if n == NO_VALUE:
+            strings.append(None)
+        else:
+            strings.append(payload[pos:pos + n].decode(errors="replace"))
+            pos += n
+    bus_id, status, last_update, driver = strings
+    return bus_id, (version, {"lat": lat, "lng": lng, "status": status,
+                              "lastUpdate": last_update, "driver": driver})
+
+
+def read_frames(data: bytes, start: int = 0):
+    """Yield (bus_id, version, payload) per frame without decoding the rest
+    of the payload; stops at the first torn or corrupt frame.
+    """
+    view = memoryview(data)
+    pos = start
+    end = len(data)
+    while pos + FRAME.size <= end:
+        length, crc = FRAME.unpack_from(data, pos)
+        body = pos + FRAME.size
+        payload = view[body:body + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        (version,) = struct.unpack_from("<Q", data, body)
+        (n,) = struct.unpack_from("<H", data, body + FIXED.size)
+        bus_id = bytes(view[body + FIXED.size + 2:body + FIXED.size + 2 + n]).decode(errors="replace")
+        yield bus_id, version, payload
+        pos = body + length
+
+
+class DurableLog:
+    def __init__(self, data_dir: str, flush_interval: float = 0.05, flush_records: int = 1000,
+                 snapshot_interval: float = 300.0, snapshot_records: int = 50000):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.active = False
+        self.store: Optional[BusStore] = None
+        self.epoch: Optional[str] = None        # store epoch the files on disk belong to
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.last_recovery: dict = {}
+        self._lock_fd: Optional[int] = None
+        self._wal = None
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bus-wal")
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    # ---------- recovery ----------
+
+    def load(self) -> Tuple[Dict[str, Record], int]:
+        """Latest state from snapshot + log tail. Returns (records, count replayed)."""
+        # Only the newest payload per bus is fully decoded
+        newest: Dict[str, Tuple[int, memoryview]] = {}
+        replayed = 0
+
+        def keep(bus_id: str, version: int, payload):
+            if bus_id not in newest or version > newest[bus_id][0]:
+                newest[bus_id] = (version, payload)
+
+        try:
+            with open(self._path("snapshot.bin"), "rb") as f:
+                data = f.read()
+            magic, _, count = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic == SNAPSHOT_MAGIC and len(data) >= SNAPSHOT_HEADER.size + 4:
+                body = data[:-4]
+                if zlib.crc32(body) == struct.unpack_from("<I", data, len(data) - 4)[0]:
+                    for frame in read_frames(body, SNAPSHOT_HEADER.size):
+                        keep(*frame)
+                else:
+                    logger.warning("Ignoring corrupt snapshot in %s", self.data_dir)
+        except (FileNotFoundError, struct.error):
+            pass
+
+        try:
+            with open(self._path("wal.log"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        valid = 0
+        for frame in read_frames(data):
+            keep(*frame)
+            replayed += 1
+            valid += FRAME.size + len(frame[2])
+        self._cut_torn_tail(len(data), valid)
+        records = dict(decode_payload(bytes(payload)) for _, payload in newest.values())
+        return records, replayed
+
+    def _cut_torn_tail(self, size: int, valid: int):
+        # Left by a crash mid-write; read_frames stops there, so anything
+        # appended after it would be unreadable
+        if valid < size:
+            logger.warning("Truncating %d corrupt bytes from wal.log", size - valid)
+            os.truncate(self._path("wal.log"), valid)
+
+    def _repair_wal(self):
+        """Cut a torn tail off wal.log without replaying it."""
+        try:
+            with open(self._path("wal.log"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        self._cut_torn_tail(len(data), sum(FRAME.size + len(p) for _, _, p in read_frames(data)))
+
+    # ---------- lifecycle ----------
+
+    def _try_lock(self) -> bool:
+        import fcntl
+        os.makedirs(self.data_dir, exist_ok=True)
+        fd = os.open(self._path("writer.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def start(self, store: BusStore):
+        """Recover into the store (if we are the writer) and start logging."""
+        self.store = store
+        store.add_listener(self._on_change)
+        if self._try_lock():
+            t0 = time.perf_counter()
+            records, replayed = await asyncio.get_running_loop().run_in_executor(self._io, self.load)
+            await store.restore(records)
+            self.last_recovery = {
+                "buses": len(records), "replayed": replayed,
+                "seconds": round(time.perf_counter() - t0, 4),
+            }
+            logger.info("Recovered %(buses)d buses, replayed %(replayed)d records in %(seconds)ss",
+                        self.last_recovery)
+            self._activate()
+        self._task = asyncio.create_task(self._run())
+
+    def _activate(self):
+        self._wal = open(self._path("wal.log"), "ab")
+        self.epoch = self.store.epoch
+        self.active = True
+        self.last_snapshot = time.monotonic()
+
+    async def _take_over(self):
+        """Become the writer after the previous one died."""
+        await asyncio.get_running_loop().run_in_executor(self._io, self._repair_wal)
+        self._activate()
+        # Changes made between the crash and now were never logged; the
+        # store has them all, so put them on disk straight away
+        self.store.sync()
+        await self.snapshot()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.active:
+            await self._flush()
+            self._wal.close()
+            self.active = False
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self._io.shutdown(wait=True)
+
+    # ---------- write path ----------
+
+    def _on_change(self, bus_id: str, version: int, remote: bool, fixes: Fixes):
+        if not self.active:
+            return
+        if self.store.epoch != self.epoch:
+            # Versions restarted; the next snapshot writes the whole new state
+            self._wake.set()
+            return
+        self.buffer += encode_record(bus_id, version, self.store.buses[bus_id])
+        self.buffered += 1
+        if self.buffered >= self.flush_records:
+            self._wake.set()
+
+    def _write(self, data: bytes):
+        self._wal.write(data)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+    async def _flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.since_snapshot += self.buffered
+        self.buffer.clear()
+        self.buffered = 0
+        await asyncio.get_running_loop().run_in_executor(self._io, self._write, data)
+
+    def _truncate_wal(self):
+        self._wal.truncate(0)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+    def _write_snapshot(self, pending: bytes, state: bytes, new_epoch: bool = False):
+        tmp = self._path("snapshot.tmp")
+        with open(tmp, "wb") as f:
+            f.write(state)
+            f.write(struct.pack("<I", zlib.crc32(state)))
+            f.flush()
+            os.fsync(f.fileno())
+        if new_epoch:
+            # The old log's versions would outrank the new state, so it goes
+            # before the snapshot is swapped in; a crash in between leaves the
+            # old snapshot alone, which is consistent, if older.
+            self._truncate_wal()
+        else:
+            # The snapshot covers everything in the log, so the log is only
+            # emptied after the snapshot is safely on disk.
+            self._write(pending)
+        os.replace(tmp, self._path("snapshot.bin"))
+        dir_fd = os.open(self.data_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        if not new_epoch:
+            self._truncate_wal()
+
+    async def snapshot(self):
+        """Write the full current state and start a new, empty log."""
+        store = self.store
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, store.version, len(store.buses))]
+        for bus_id, bus in store.buses.items():
+            parts.append(encode_record(bus_id, store.bus_versions.get(bus_id, 0), bus))
+        new_epoch = store.epoch != self.epoch
+        self.epoch = store.epoch
+        pending = bytes(self.buffer)
+        self.buffer.clear()
+        self.buffered = 0
+        self.since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(
+            self._io, self._write_snapshot, pending, b"".join(parts), new_epoch)
+
+    async def _run(self):
+        while True:
+            if not self.active:
+                # Another worker is writing; take over if it goes away
+                await asyncio.sleep(1.0)
+                if self._try_lock():
+                    try:
+                        await self._take_over()
+                    except OSError:
+                        logger.exception("Failed to take over bus state in %s", self.data_dir)
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._flush()
+                if (self.store.epoch != self.epoch
+                        or self.since_snapshot >= self.snapshot_records
+                        or time.monotonic() - self.last_snapshot >= self.snapshot_interval):
+                    await self.snapshot()
+            except OSError:
+                logger.exception("Failed to write bus state to %s", self.data_dir)
+
+
+def create_durable_log() -> Optional[DurableLog]:
+    """DurableLog in BUS_DATA_DIR (default ./bus-data); set it empty to disable."""
+    data_dir = os.environ.get("BUS_DATA_DIR", "bus-data")
+    return DurableLog(data_dir) if data_dir else None
@@ -0,0 +1,136 @@
+"""Grid index over bus positions for nearest-bus queries.
+
+The world is cut into fixed-size lat/lng cells. A location update only moves
+the bus between two cells, and a query only computes distances (vectorized
+haversine with NumPy) for buses in the cells overlapping the search radius.
+"""
+import math
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEG_LAT = 111320.0
+
+Cell = Tuple[int, int]
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters; works on scalars or NumPy arrays."""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """Cells hold integer slots; positions live in NumPy arrays indexed by slot,
+    so a query gathers candidate coordinates with one fancy-index instead of
+    building an array from Python tuples.
+    """
+
+    def __init__(self, cell_deg: float = 0.01, initial_capacity: int = 64):
+        # 0.01 deg is about 1.1 km of latitude
+        self.cell_deg = cell_deg
+        self.cells: Dict[Cell, Set[int]] = {}
+        self.slot_of: Dict[str, int] = {}
+        self.cell_of: Dict[str, Cell] = {}
+        self.ids: List[Optional[str]] = []
+        self.free: List[int] = []
+        self.lats = np.full(initial_capacity, np.nan)
+        self.lngs = np.full(initial_capacity, np.nan)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _new_slot(self, bus_id: str) -> int:
+        if self.free:
+            slot = self.free.pop()
+            self.ids[slot] = bus_id
+        else:
+            slot = len(self.ids)
+            self.ids.append(bus_id)
+            if slot == len(self.lats):
+                self.lats = np.concatenate([self.lats, np.full(slot, np.nan)])
+                self.lngs = np.concatenate([self.lngs, np.full(slot, np.nan)])
+        self.slot_of[bus_id] = slot
+        return slot
+
+    def update(self, bus_id: str, lat: float, lng: float):
+        """Insert or move a bus. O(1): only touches the old and new cell."""
+        slot = self.slot_of.get(bus_id)
+        if slot is None:
+            slot = self._new_slot(bus_id)
+        self.lats[slot] = lat
+        self.lngs[slot] = lng
+        cell = self._cell(lat, lng)
+        old = self.cell_of.get(bus_id)
+        if old == cell:
+            return
+        if old is not None:
+            self._leave(old, slot)
+        self.cells.setdefault(cell, set()).add(slot)
+        self.cell_of[bus_id] = cell
+
+    def _leave(self, cell: Cell, slot: int):
+        members = self.cells[cell]
+        members.discard(slot)
+        if not members:
+            del self.cells[cell]
+
+    def remove(self, bus_id: str):
+        slot = self.slot_of.pop(bus_id, None)
+        if slot is None:
+            return
+        self._leave(self.cell_of.pop(bus_id), slot)
+        self.lats[slot] = self.lngs[slot] = np.nan
+        self.ids[slot] = None
+        self.free.append(slot)
+
+    def candidates(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """Slots in every cell that overlaps the bounding box of the circle."""
+        dlat = radius_m / METERS_PER_DEG_LAT
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        dlng = min(radius_m / (METERS_PER_DEG_LAT * cos_lat), 180.0)
+        lat_lo, lng_lo = self._cell(lat - dlat, lng - dlng)
+        lat_hi, lng_hi = self._cell(lat + dlat, lng + dlng)
+
+        out: List[int] = []
+        if (lat_hi - lat_lo + 1) * (lng_hi - lng_lo + 1) > len(self.cells):
+            # Huge radius: walking the occupied cells is cheaper than the box
+            for (ci, cj), members in self.cells.items():
+                if lat_lo <= ci <= lat_hi and lng_lo <= cj <= lng_hi:
+                    out.extend(members)
+        else:
+            for ci in range(lat_lo, lat_hi + 1):
+                for cj in range(lng_lo, lng_hi + 1):
+                    members = self.cells.get((ci, cj))
+                    if members:
+                        out.extend(members)
+        return np.fromiter(out, dtype=np.intp, count=len(out))
+
+    def nearest(self, lat: float, lng: float, radius_m: float, k: int,
+                keep: Optional[Callable[[str], bool]] = None) -> List[Tuple[str, float]]:
+        """Up to k (bus_id, distance_m) pairs within radius_m, closest first.
+
+        keep, if given, filters buses that are within the radius.
+        """
+        slots = self.candidates(lat, lng, radius_m)
+        if not len(slots):
+            return []
+        dist = haversine_m(lat, lng, self.lats[slots], self.lngs[slots])
+        inside = np.flatnonzero(dist <= radius_m)
+        if keep is None and len(inside) > k:
+            inside = inside[np.argpartition(dist[inside], k - 1)[:k]]
+        inside = inside[np.argsort(dist[inside], kind="stable")]
+
+        out = []
+        for i in inside:
+            bus_id = self.ids[slots[i]]
+            if keep is None or keep(bus_id):
+                out.append((bus_id, float(dist[i])))
+                if len(out) == k:
+                    break
+        return out
@@ -0,0 +1,501 @@
+"""Pluggable storage for live bus state, so several uvicorn workers agree.
+
+Every backend keeps a plain dict of buses in-process (the "view") that
+handlers read directly. Mutations go through `await store.update()`, which
+makes the change visible to every worker and returns its version. Changes
+from other workers are folded into the view by `sync()` (or the hub reader
+for the pub/sub backend), and every change - local or remote - is reported
+to the listeners registered with `add_listener()`.
+
+An update may carry the location fixes behind it as (ts, lat, lng) points.
+Only the fields are state; the fixes are passed along to every worker's
+listeners so per-worker history and ETAs see every point of a batch, not
+just the newest one.
+
+Backends:
+    memory  single process, no sharing (default)
+    shm     mmap'd file of fixed-size records, for several workers on one host
+    pubsub  TCP hub that sequences and relays updates; run it with
+            `python store.py hub --port 7400`
+
+Versions come from one shared sequence (the shm header, or the hub), so
+ETags and ?since=<version> mean the same thing on every worker.
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import struct
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+STATE_FIELDS = ("lat", "lng", "status", "lastUpdate", "driver")
+
+Fixes = Sequence[Tuple[float, float, float]]       # (ts, lat, lng) per point
+Listener = Callable[[str, int, bool, Fixes], None]
+
+
+class StoreUnavailable(Exception):
+    """The shared backend could not be reached; the update was not applied."""
+
+
+class BusStore:
+    """In-process store. Also the base class for the shared backends."""
+
+    def __init__(self, buses: Dict[str, dict]):
+        self.buses = buses
+        self.version = 0
+        self.bus_versions: Dict[str, int] = {bus_id: 0 for bus_id in buses}
+        self.epoch = os.urandom(4).hex()
+        self.listeners: List[Listener] = []
+
+    def add_listener(self, fn: Listener):
+        """fn(bus_id, version, remote, fixes) is called after every change."""
+        self.listeners.append(fn)
+
+    def _apply(self, bus_id: str, fields: dict, version: int, remote: bool, fixes: Fixes = ()):
+        self.buses[bus_id].update(fields)
+        self.bus_versions[bus_id] = version
+        if version > self.version:
+            self.version = version
+        for fn in self.listeners:
+            fn(bus_id, version, remote, fixes)
+
+    async def update(self, bus_id: str, fields: dict, fixes: Fixes = ()) -> int:
+        self._apply(bus_id, fields, self.version + 1, remote=False, fixes=fixes)
+        return self.version
+
+    def sync(self) -> int:
+        """Pull in changes made by other workers; returns how many."""
+        return 0
+
+    async def restore(self, records: Dict[str, Tuple[int, dict]]):
+        """Load recovered (version, fields) per bus where newer than what we hold."""
+        for bus_id, (version, fields) in records.items():
+            if bus_id in self.buses and version > self.bus_versions.get(bus_id, 0):
+                self._apply(bus_id, fields, version, remote=True)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SharedMemoryStore(BusStore):
+    """Bus state in a memory-mapped file shared by all workers on one host.
+
+    One fixed-size record per bus, in sorted bus id order. Writers take an
+    exclusive flock on the file, bump the global version in the header and
+    write the record under a seqlock; readers never lock, they retry if the
+    sequence number was odd or moved while they copied the record.
+
+    After the records comes a ring of the last `fix_slots` fixes, each tagged
+    with its bus and the version of the update that carried it. A writer
+    reserves ring slots, writes the fixes, publishes the new ring head and
+    only then writes the record, so a reader that has seen a record finds
+    its fixes in the ring; entries the reservation counter shows may have
+    been overwritten while they were copied are dropped.
+    """
+
+    MAGIC = b"BUSSTOR2"
+    HEADER = struct.Struct("<8s8sQI")                  # magic, epoch, version, bus count
+    HEADER_SIZE = 64
+    RECORD = struct.Struct("<QQdd16s40s32s")            # seq, version, lat, lng, status, lastUpdate, driver
+    RECORD_SIZE = 128
+    FIX = struct.Struct("<QI4xddd")                     # version, slot, ts, lat, lng
+    VERSION_OFFSET = 16
+    FIX_RESERVED_OFFSET = 32                            # ring slots handed out to writers
+    FIX_HEAD_OFFSET = 40                                # ring entries fully written
+
+    def __init__(self, buses: Dict[str, dict], path: str, poll_interval: float = 0.02,
+                 fix_slots: int = 16384):
+        super().__init__(buses)
+        import fcntl  # POSIX only; the memory backend keeps working elsewhere
+        self._fcntl = fcntl
+        self.path = path
+        self.poll_interval = poll_interval
+        self.ids = sorted(buses)
+        self.slots = {bus_id: i for i, bus_id in enumerate(self.ids)}
+        self._seen = 0
+        self._fix_cursor = 0
+        self._held: Dict[int, list] = {}     # fixes read for records not applied yet
+        self._task: Optional[asyncio.Task] = None
+
+        self.fix_slots = fix_slots
+        self.ring_offset = self.HEADER_SIZE + self.RECORD_SIZE * len(self.ids)
+        size = self.ring_offset + self.FIX.size * fix_slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, self.HEADER.size, 0)
+            fresh = len(header) < self.HEADER.size or os.fstat(self.fd).st_size != size
+            if not fresh:
+                magic, _, _, count = self.HEADER.unpack(header)
+                fresh = magic != self.MAGIC or count != len(self.ids)
+            if fresh:
+                os.ftruncate(self.fd, size)
+            self.mm = mmap.mmap(self.fd, size)
+            if fresh:
+                self.mm[:] = bytes(size)
+                self.HEADER.pack_into(self.mm, 0, self.MAGIC, os.urandom(4).hex().encode(), 0, len(self.ids))
+                for bus_id in self.ids:
+                    self._write_record(bus_id, buses[bus_id], 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.epoch = self.HEADER.unpack_from(self.mm, 0)[1].decode()
+        self.sync()
+
+    @staticmethod
+    def _text(value, size: int) -> bytes:
+        raw = (value or "").encode()[:size]
+        return raw.decode(errors="ignore").encode()   # don't cut a UTF-8 sequence in half
+
+    def _write_record(self, bus_id: str, bus: dict, version: int):
+        off = self.HEADER_SIZE + self.slots[bus_id] * self.RECORD_SIZE
+        seq = struct.unpack_from("<Q", self.mm, off)[0]
+        struct.pack_into("<Q", self.mm, off, seq + 1)          # odd: write in progress
+        self.RECORD.pack_into(
+            self.mm, off, seq + 1, version, bus["lat"], bus["lng"],
+            self._text(bus.get("status"), 16), self._text(bus.get("lastUpdate"), 40),
+            self._text(bus.get("driver"), 32),
+        )
+        struct.pack_into("<Q", self.mm, off, seq + 2)
+
+    def _read_record(self, slot: int):
+        off = self.HEADER_SIZE + slot * self.RECORD_SIZE
+        while True:
+            rec = self.RECORD.unpack_from(self.mm, off)
+            if rec[0] % 2 == 0 and struct.unpack_from("<Q", self.mm, off)[0] == rec[0]:
+                return rec
+
+    def _counter(self, offset: int) -> int:
+        return struct.unpack_from("<Q", self.mm, offset)[0]
+
+    def _append_fixes(self, slot: int, version: int, fixes: Fixes):
+        # Caller holds the flock
+        fixes = fixes[-self.fix_slots:]
+        head = self._counter(self.FIX_HEAD_OFFSET)
+        struct.pack_into("<Q", self.mm, self.FIX_RESERVED_OFFSET, head + len(fixes))
+        for i, (ts, lat, lng) in enumerate(fixes):
+            off = self.ring_offset + (head + i) % self.fix_slots * self.FIX.size
+            self.FIX.pack_into(self.mm, off, version, slot, ts, lat, lng)
+        struct.pack_into("<Q", self.mm, self.FIX_HEAD_OFFSET, head + len(fixes))
+
+    def _read_fixes(self, upto: int) -> Dict[int, list]:
+        """Ring entries since the last call with version <= upto, per slot."""
+        head = self._counter(self.FIX_HEAD_OFFSET)
+        start = max(self._fix_cursor, head - self.fix_slots)
+        entries = [self.FIX.unpack_from(self.mm, self.ring_offset + i % self.fix_slots * self.FIX.size)
+                   for i in range(start, head)]
+        # Slots a writer reserved while we copied may hold newer fixes now
+        first_intact = self._counter(self.FIX_RESERVED_OFFSET) - self.fix_slots
+        per_slot: Dict[int, list] = {}
+        self._fix_cursor = head
+        for i, (version, slot, ts, lat, lng) in enumerate(entries, start):
+            if version > upto:
+                # Belongs to an update after this sync's head; read it next time
+                self._fix_cursor = i
+                break
+            if i >= first_intact:
+                per_slot.setdefault(slot, []).append((version, ts, lat, lng))
+        return per_slot
+
+    def _record_fields(self, rec) -> dict:
+        _, _, lat, lng, status, last_update, driver = rec
+        return {
+            "lat": lat, "lng": lng,
+            "status": status.rstrip(b"\0").decode(),
+            "lastUpdate": last_update.rstrip(b"\0").decode(),
+            "driver": driver.rstrip(b"\0").decode() or None,
+        }
+
+    async def update(self, bus_id: str, fields: dict, fixes: Fixes = ()) -> int:
+        slot = self.slots[bus_id]
+        self._fcntl.flock(self.fd, self._fcntl.LOCK_EX)
+        try:
+            # Merge with the shared record, not our view, which may be a tick behind
+            merged = {**self._record_fields(self._read_record(slot)), **fields}
+            version = self._counter(self.VERSION_OFFSET) + 1
+            if fixes:
+                self._append_fixes(slot, version, fixes)
+            self._write_record(bus_id, merged, version)
+            struct.pack_into("<Q", self.mm, self.VERSION_OFFSET, version)
+        finally:
+            self._fcntl.flock(self.fd, self._fcntl.LOCK_UN)
+        self._apply(bus_id, merged, version, remote=False, fixes=fixes)
+        return version
+
+    async def restore(self, records: Dict[str, Tuple[int, dict]]):
+        # Write recovered records into the shared file; every worker (us
+        # included) then picks them up through sync()
+        self._fcntl.flock(self.fd, self._fcntl.LOCK_EX)
+        try:
+            head = struct.unpack_from("<Q", self.mm, self.VERSION_OFFSET)[0]
+            for bus_id, (version, fields) in records.items():
+                slot = self.slots.get(bus_id)
+                if slot is None or version <= self._read_record(slot)[1]:
+                    continue
+                merged = {**self._record_fields(self._read_record(slot)), **fields}
+                self._write_record(bus_id, merged, version)
+                head = max(head, version)
+            struct.pack_into("<Q", self.mm, self.VERSION_OFFSET, head)
+        finally:
+            self._fcntl.flock(self.fd, self._fcntl.LOCK_UN)
+        self.sync()
+
+    def sync(self) -> int:
+        head = self._counter(self.VERSION_OFFSET)
+        if head == self._seen:
+            return 0
+        changed = []
+        for slot, bus_id in enumerate(self.ids):
+            off = self.HEADER_SIZE + slot * self.RECORD_SIZE
+            version = struct.unpack_from("<Q", self.mm, off + 8)[0]
+            # Newer than head: a writer is still between the record and the
+            # header bump, and its fixes may not all be readable yet. The
+            # bump will bring us back for it.
+            if version <= self.bus_versions[bus_id] or version > head:
+                continue
+            rec = self._read_record(slot)
+            if rec[1] <= head:
+                changed.append((slot, bus_id, rec))
+        # Records first, then the ring: the fixes of every record read are in it
+        fixes = self._read_fixes(head)
+        for slot, held in self._held.items():
+            fixes[slot] = held + fixes.get(slot, [])
+        self._held = {}
+        for slot, bus_id, rec in changed:
+            seen = self.bus_versions[bus_id]
+            points = [(ts, lat, lng) for version, ts, lat, lng in fixes.pop(slot, ())
+                      if seen < version <= rec[1]]
+            self._apply(bus_id, self._record_fields(rec), rec[1], remote=True, fixes=points)
+        # Fixes of records skipped above wait for the sync that applies them
+        for slot, entries in fixes.items():
+            seen = self.bus_versions[self.ids[slot]]
+            entries = [e for e in entries if e[0] > seen]
+            if entries:
+                self._held[slot] = entries
+        self._seen = head
+        return len(changed)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.sync()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.mm.close()
+        os.close(self.fd)
+
+
+class PubSubStore(BusStore):
+    """Bus state replicated through a `PubSubHub` over TCP.
+
+    The hub gives every update a sequence number and relays it to all
+    connected workers, the writer included. `update()` returns once the
+    write has come back from the hub, so the local view is then up to date.
+    """
+
+    def __init__(self, buses: Dict[str, dict], host: str = "127.0.0.1", port: int = 7400,
+                 timeout: float = 2.0):
+        super().__init__(buses)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.client_id = os.urandom(6).hex()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_req = 0
+        self._connected = asyncio.Event()
+        self._closing = False
+        self.hub_version = 0
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        self._writer = writer
+        self._reader_task = asyncio.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._handle(json.loads(line))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._writer = None
+            self._connected.clear()
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(StoreUnavailable("lost connection to hub"))
+            self._pending.clear()
+            if not self._closing:
+                asyncio.get_running_loop().create_task(self._reconnect())
+
+    def _handle(self, msg: dict):
+        if msg["op"] == "hello":
+            if msg["epoch"] != self.epoch:
+                # A new hub numbers from 1 again; drop the old hub's versions
+                # before it replays its state, or ours would stay ahead of it
+                self.version = 0
+                self.bus_versions = {bus_id: 0 for bus_id in self.buses}
+            self.epoch = msg["epoch"]
+            self.hub_version = msg["version"]
+            self._connected.set()
+            return
+        bus_id = msg["bus"]
+        if bus_id not in self.buses:
+            return
+        mine = msg.get("origin") == self.client_id
+        fields = {k: v for k, v in msg["fields"].items() if k in STATE_FIELDS}
+        self._apply(bus_id, fields, msg["version"], remote=not mine, fixes=msg.get("fixes") or ())
+        fut = self._pending.pop(msg.get("req"), None) if mine else None
+        if fut is not None and not fut.done():
+            fut.set_result(msg["version"])
+
+    async def _reconnect(self):
+        delay = 0.1
+        while not self._closing and self._writer is None:
+            try:
+                await self._connect()
+                return
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    async def update(self, bus_id: str, fields: dict, fixes: Fixes = ()) -> int:
+        if self._writer is None:
+            try:
+                await self._connect()
+            except OSError as e:
+                raise StoreUnavailable(f"cannot reach hub at {self.host}:{self.port}: {e}")
+        self._next_req += 1
+        req = self._next_req
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req] = fut
+        msg = {"op": "set", "bus": bus_id, "fields": fields, "req": req, "origin": self.client_id}
+        if fixes:
+            msg["fixes"] = [list(f) for f in fixes]
+        self._writer.write(json.dumps(msg).encode() + b"\n")
+        try:
+            return await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(req, None)
+            raise StoreUnavailable("hub did not acknowledge the update")
+
+    async def restore(self, records: Dict[str, Tuple[int, dict]]):
+        # Hub versions restart with the hub, so recovered versions can't be
+        # reused; only seed a hub that has no state yet.
+        if self.hub_version or not self._connected.is_set():
+            return
+        for bus_id, (_, fields) in records.items():
+            if bus_id in self.buses:
+                await self.update(bus_id, fields)
+
+    async def start(self):
+        try:
+            await self._connect()
+            await asyncio.wait_for(self._connected.wait(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def close(self):
+        self._closing = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+class PubSubHub:
+    """Sequencer and relay for `PubSubStore` workers.
+
+    Keeps the latest fields of every bus, so a worker that (re)connects is
+    sent the full state before live updates. Fixes are relayed, not kept. Clients whose send buffer grows
+    past max_buffer are dropped instead of slowing everybody down.
+    """
+
+    def __init__(self, max_buffer: int = 1 << 20):
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.state: Dict[str, dict] = {}
+        self.bus_versions: Dict[str, int] = {}
+        self.clients = set()
+        self.max_buffer = max_buffer
+
+    def _send(self, writer: asyncio.StreamWriter, msg: dict):
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            writer.close()
+            self.clients.discard(writer)
+            return
+        writer.write(json.dumps(msg).encode() + b"\n")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._send(writer, {"op": "hello", "epoch": self.epoch, "version": self.version})
+        for bus_id, fields in self.state.items():
+            self._send(writer, {"op": "set", "bus": bus_id, "fields": fields,
+                                "version": self.bus_versions[bus_id], "origin": "hub"})
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if msg.get("op") != "set":
+                    continue
+                self.version += 1
+                fields = self.state.setdefault(msg["bus"], {})
+                fields.update(msg["fields"])
+                self.bus_versions[msg["bus"]] = self.version
+                out = {**msg, "fields": fields, "version": self.version}
+                for client in list(self.clients):
+                    self._send(client, out)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 7400):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def create_store(buses: Dict[str, dict], backend: Optional[str] = None) -> BusStore:
+    """Pick a backend from BUS_STORE (memory, shm or pubsub)."""
+    backend = backend or os.environ.get("BUS_STORE", "memory")
+    if backend == "memory":
+        return BusStore(buses)
+    if backend == "shm":
+        default = "/dev/shm/bus-tracker.state" if os.path.isdir("/dev/shm") else "bus-tracker.state"
+        return SharedMemoryStore(buses, os.environ.get("BUS_STORE_PATH", default))
+    if backend == "pubsub":
+        host, _, port = os.environ.get("BUS_STORE_HUB", "127.0.0.1:7400").rpartition(":")
+        return PubSubStore(buses, host or "127.0.0.1", int(port))
+    raise ValueError(f"Unknown BUS_STORE backend: {backend}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bus state pub/sub hub")
+    parser.add_argument("command", choices=["hub"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7400)
+    args = parser.parse_args()
+
+    async def run_hub():
+        server = await PubSubHub().serve(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run_hub())
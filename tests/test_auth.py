@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import pytest
+
+from auth import PasswordVerifier, TokenAuthority, VerifierBusy, hash_password, verify_password
+
+
+def test_token_round_trip():
+    tokens = TokenAuthority(b"secret")
+    claims = tokens.verify(tokens.issue("driver1", "driver", bus="1"))
+    assert claims["sub"] == "driver1" and claims["role"] == "driver" and claims["bus"] == "1"
+
+
+@pytest.mark.parametrize("mangle", [
+    lambda t: t[:-2] + ("A" if t[-2] != "A" else "B") + t[-1],   # signature
+    lambda t: "f" + t[1:],                                        # claims
+    lambda t: t.partition(".")[0],                                # no signature
+    lambda t: t + "\xe9",                                         # non-ASCII
+    lambda t: "€." + t.partition(".")[2],
+    lambda t: "",
+])
+def test_tampered_tokens_are_rejected(mangle):
+    tokens = TokenAuthority(b"secret")
+    assert tokens.verify(mangle(tokens.issue("driver1", "driver", bus="1"))) is None
+
+
+def test_tokens_from_another_key_or_expired_are_rejected():
+    token = TokenAuthority(b"other").issue("driver1", "driver")
+    assert TokenAuthority(b"secret").verify(token) is None
+    tokens = TokenAuthority(b"secret", lifetime=-1)
+    assert tokens.verify(tokens.issue("driver1", "driver")) is None
+
+
+def test_cached_token_expires_with_cache_ttl():
+    tokens = TokenAuthority(b"secret", cache_ttl=0.01)
+    token = tokens.issue("driver1", "driver")
+    assert tokens.verify(token) is not None
+    time.sleep(0.02)
+    assert tokens.verify(token) is not None     # re-verified by signature
+    assert len(tokens._cache) == 1
+
+
+def test_password_hash_round_trip():
+    encoded = hash_password("pass1", n=2 ** 4)
+    assert verify_password("pass1", encoded)
+    assert not verify_password("pass2", encoded)
+    assert not verify_password("pass1", "md5$abc")
+
+
+async def _storm(verifier, encoded, n):
+    return await asyncio.gather(*(verifier.verify("pass1", encoded) for _ in range(n)),
+                                return_exceptions=True)
+
+
+def test_verifier_fails_fast_when_slots_are_taken():
+    verifier = PasswordVerifier(max_workers=1, max_pending=2)
+    results = asyncio.run(_storm(verifier, hash_password("pass1", n=2 ** 4), 5))
+    assert results[:2] == [True, True]
+    assert all(isinstance(r, VerifierBusy) for r in results[2:])
+    assert asyncio.run(_storm(verifier, None, 1)) == [False]
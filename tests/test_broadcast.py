@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from broadcast import BusBroadcaster, Subscription
+
+
+def frames_to_buses(frames):
+    out = []
+    for frame in frames:
+        for event in frame.decode().strip().split("\n\n"):
+            out.append(json.loads(event.split("data: ", 1)[1]))
+    return out
+
+
+def test_subscription_keeps_latest_frame_per_bus():
+    sub = Subscription(max_pending=10)
+    sub.push("1", b"old")
+    sub.push("2", b"two")
+    sub.push("1", b"new")
+    assert sub.dropped == 1
+    assert asyncio.run(sub.next_frames(timeout=0)) == [b"two", b"new"]
+
+
+def test_subscription_drops_stalest_bus_when_full():
+    sub = Subscription(max_pending=2)
+    for bus_id in ("1", "2", "3"):
+        sub.push(bus_id, bus_id.encode())
+    assert sub.dropped == 1
+    assert list(sub.pending) == ["2", "3"]
+
+
+async def _coalesce():
+    buses = {"1": {"lat": 0.0}, "2": {"lat": 0.0}}
+    broadcaster = BusBroadcaster(buses.get, tick=0.01)
+    everything = broadcaster.subscribe()
+    only_two = broadcaster.subscribe(["2"])
+    for i in range(5):
+        buses["1"]["lat"] = float(i)
+        broadcaster.publish("1")
+    broadcaster.publish("2")
+    await asyncio.sleep(0.05)
+    # One frame per bus per tick, carrying the latest position
+    got = frames_to_buses(await everything.next_frames(timeout=0))
+    assert sorted((b["id"], b["lat"]) for b in got) == [("1", 4.0), ("2", 0.0)]
+    assert [b["id"] for b in frames_to_buses(await only_two.next_frames(timeout=0))] == ["2"]
+    assert await everything.next_frames(timeout=0.02) == []
+
+
+def test_broadcaster_coalesces_per_tick_and_filters():
+    asyncio.run(_coalesce())
+
+
+async def _disconnect():
+    buses = {"1": {"lat": 1.0}, "2": {"lat": 2.0}}
+    broadcaster = BusBroadcaster(buses.get, tick=0.01)
+    sub = broadcaster.subscribe(["1"])
+    stream = broadcaster.stream(sub, {k: dict(v) for k, v in buses.items()}, heartbeat=0.01)
+    assert frames_to_buses([await stream.__anext__()]) == [{"id": "1", "lat": 1.0}]
+    assert await stream.__anext__() == b": keep-alive\n\n"
+    broadcaster.publish("1")
+    assert frames_to_buses([await stream.__anext__()]) == [{"id": "1", "lat": 1.0}]
+    # Client went away: closing the generator unsubscribes it
+    await stream.aclose()
+    assert broadcaster.subscribers == set()
+    broadcaster.publish("1")
+    assert broadcaster._flush_handle is None
+
+
+def test_stream_sends_snapshot_heartbeat_and_unsubscribes_on_close():
+    asyncio.run(_disconnect())
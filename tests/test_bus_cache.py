@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from bus_cache import BusSnapshotCache
+from store import BusStore
+
+
+def make_cache():
+    store = BusStore({
+        "1": {"lat": 1.0, "lng": 2.0, "status": "inactive", "lastUpdate": None, "driver": None},
+        "2": {"lat": 3.0, "lng": 4.0, "status": "inactive", "lastUpdate": None, "driver": None},
+    })
+    return store, BusSnapshotCache(store)
+
+
+def test_etag_matches_until_the_store_changes():
+    store, cache = make_cache()
+    body, etag = cache.body()
+    assert cache.matches(etag)
+    assert cache.matches(f'"other", {etag}')
+    assert cache.matches(f"W/{etag}")       # weak comparison, e.g. after a gzip proxy
+    assert cache.matches("*")
+    assert not cache.matches(None) and not cache.matches('"other"')
+
+    asyncio.run(store.update("1", {"lat": 5.0}))
+    assert not cache.matches(etag)
+    new_body, new_etag = cache.body()
+    assert new_etag != etag and b"5.0" in new_body
+    assert cache.body()[0] is new_body      # re-encoded only on change
+
+
+def test_since_returns_only_changed_buses():
+    store, cache = make_cache()
+    asyncio.run(store.update("1", {"lat": 5.0}))
+    asyncio.run(store.update("2", {"lat": 6.0}))
+    assert set(cache.changed_since("0")) == {"1", "2"}
+    assert set(cache.changed_since("1")) == {"2"}
+    assert cache.changed_since("2") == {}
+    # The ETag value works as a token, with or without quotes or W/
+    etag = cache.etag
+    for token in (etag, etag.strip('"'), f"W/{etag}"):
+        assert cache.changed_since(token) == {}
+    assert set(cache.changed_since(f"{store.epoch}-1")) == {"2"}
+
+
+def test_since_from_another_epoch_or_ahead_returns_everything():
+    store, cache = make_cache()
+    asyncio.run(store.update("1", {"lat": 5.0}))
+    assert set(cache.changed_since("deadbeef-1")) == {"1", "2"}
+    assert set(cache.changed_since("1000000")) == {"1", "2"}
+
+
+@pytest.mark.parametrize("token", ["", "-1", "abc", "1.5", "ab-", "ab-x", "+1", "¹"])
+def test_malformed_since_is_rejected(token):
+    _, cache = make_cache()
+    with pytest.raises(ValueError):
+        cache.changed_since(token)
@@ -0,0 +1,48 @@
+from eta import EtaEngine, Route
+
+# Straight east-west road, about 1 km long, driven out to B and back to A
+A = (12.9700, 77.5900)
+B = (12.9700, 77.5992)
+MID = (12.9700, 77.5946)
+
+
+def out_and_back():
+    return Route("r", [A, MID, B, MID, A], [("a", *A), ("b", *B), ("a2", *A)])
+
+
+def test_stops_are_placed_in_route_order():
+    route = out_and_back()
+    (_, a), (_, b), (_, a2) = route.stops
+    assert a == 0.0
+    assert abs(b - route.length / 2) < 1.0
+    assert abs(a2 - route.length) < 1.0
+
+
+def test_projection_keeps_a_returning_bus_on_the_return_leg():
+    route = out_and_back()
+    half = route.length / 2
+    on_return = route.project(*MID, prev_along=half + 100)
+    assert abs(on_return.along - half * 1.5) < 1.0
+    on_way_out = route.project(*MID, prev_along=half / 2 - 100)
+    assert abs(on_way_out.along - half / 2) < 1.0
+
+
+def test_projection_tolerates_jitter_backwards():
+    route = out_and_back()
+    half = route.length / 2
+    # Just past the midpoint on the way out; a fix 10 m behind stays on this leg
+    p = route.project(*MID, prev_along=half / 2 + 10)
+    assert abs(p.along - half / 2) < 1.0
+
+
+def test_bus_on_return_leg_gets_no_eta_for_the_far_end():
+    engine = EtaEngine({"r": out_and_back()}, {"bus": "r"})
+    lng_step = (B[1] - A[1]) / 10
+    ts = 0.0
+    for i in list(range(11)) + list(range(9, 4, -1)):
+        ts += 20
+        engine.observe("bus", ts, A[0], A[1] + i * lng_step)
+    engine.refresh("bus", now=ts)
+    etas = engine.bus_etas("bus")
+    assert "b" not in etas and "a" not in etas
+    assert etas["a2"][1] < out_and_back().length / 2
@@ -0,0 +1,43 @@
+from history import POINT_BYTES, BusTrack, HistoryStore, create_history_store
+
+
+def test_track_grows_on_demand_up_to_capacity():
+    track = BusTrack(capacity=300)
+    assert len(track.ts) == 0
+    for i in range(100):
+        track.append(float(i), 1.0, 2.0)
+    assert len(track.ts) == 128
+    for i in range(100, 1000):
+        track.append(float(i), 1.0, 2.0)
+    assert len(track.ts) == 300
+    assert track.size == 300
+    assert [p[0] for p in track.range(float("-inf"), float("inf"), 1000)] == [float(i) for i in range(700, 1000)]
+
+
+def test_track_keeps_order_when_growing_after_expiry():
+    track = BusTrack(capacity=1000)
+    expected = []
+    for i in range(500):
+        track.append(float(i), float(i), -float(i))
+        expected.append((float(i), float(i), -float(i)))
+        if i % 50 == 49:
+            track.expire(i - 20.0)
+            expected = [p for p in expected if p[0] >= i - 20.0]
+    assert track.range(float("-inf"), float("inf"), 1000) == expected
+
+
+def test_track_refuses_out_of_order_points():
+    track = BusTrack(capacity=10)
+    assert track.append(5.0, 0.0, 0.0)
+    assert not track.append(5.0, 1.0, 1.0)
+    assert not track.append(4.0, 1.0, 1.0)
+    assert track.size == 1
+
+
+def test_store_capacity_comes_from_byte_budget(monkeypatch):
+    monkeypatch.setenv("BUS_HISTORY_MAX_BYTES_PER_BUS", str(100 * POINT_BYTES))
+    monkeypatch.setenv("BUS_HISTORY_RETENTION", "60")
+    store = create_history_store()
+    assert store.capacity == 100
+    assert store.retention == 60.0
+    assert HistoryStore().query("missing") == []
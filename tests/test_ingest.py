@@ -0,0 +1,55 @@
+import math
+
+import pytest
+
+from ingest import MAX_CLOCK_SKEW, Fix, order_fixes, parse_fixes, parse_timestamp
+
+NOW = 1_700_000_000.0
+
+
+def fix(ts, bus_id="1", lat=12.97, lng=77.59):
+    return Fix(ts, bus_id, lat, lng, str(ts))
+
+
+def test_parse_timestamp_accepts_iso_and_epoch():
+    assert parse_timestamp(NOW) == NOW
+    assert parse_timestamp(1700000000) == NOW
+    assert parse_timestamp("2023-11-14T22:13:20+00:00") == NOW
+
+
+@pytest.mark.parametrize("value", [math.inf, -math.inf, math.nan, 1e300, 10 ** 400,
+                                   True, None, "yesterday", [NOW]])
+def test_parse_timestamp_rejects_garbage(value):
+    assert parse_timestamp(value) is None
+
+
+def test_parse_fixes_rejects_out_of_range_timestamp():
+    for body in (b'[{"bus_id": "1", "lat": 1, "lng": 2, "timestamp": Infinity}]',
+                 b'[{"bus_id": "1", "lat": 1, "lng": 2, "timestamp": 1e300}]'):
+        with pytest.raises(ValueError, match="fix 0: timestamp"):
+            parse_fixes(body)
+
+
+def test_parse_fixes_ndjson_with_default_bus():
+    body = b'{"lat": 1, "lng": 2, "timestamp": 10}\n\n{"lat": 3, "lng": 4, "timestamp": "1970-01-01T00:00:20+00:00"}\n'
+    fixes = parse_fixes(body, ndjson=True, default_bus_id="7")
+    assert [(f.bus_id, f.ts, f.lat) for f in fixes] == [("7", 10.0, 1.0), ("7", 20.0, 3.0)]
+
+
+def test_order_fixes_sorts_per_bus_and_drops_duplicates():
+    fixes = [fix(NOW - 1), fix(NOW - 3), fix(NOW - 2, "2"), fix(NOW - 3), fix(NOW - 2)]
+    per_bus = order_fixes(fixes, {}, now=NOW)
+    assert [f.ts for f in per_bus["1"]] == [NOW - 3, NOW - 2, NOW - 1]
+    assert [f.ts for f in per_bus["2"]] == [NOW - 2]
+
+
+def test_order_fixes_drops_fixes_not_newer_than_last_applied():
+    per_bus = order_fixes([fix(NOW - 10), fix(NOW - 5), fix(NOW - 1)], {"1": NOW - 5}, now=NOW)
+    assert [f.ts for f in per_bus["1"]] == [NOW - 1]
+    assert order_fixes([fix(NOW - 10)], {"1": NOW - 5}, now=NOW) == {}
+
+
+def test_order_fixes_drops_fixes_from_the_future():
+    fixes = [fix(NOW), fix(NOW + MAX_CLOCK_SKEW), fix(NOW + MAX_CLOCK_SKEW + 1), fix(4102444800.0)]
+    per_bus = order_fixes(fixes, {}, now=NOW)
+    assert [f.ts for f in per_bus["1"]] == [NOW, NOW + MAX_CLOCK_SKEW]
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from metrics import Histogram, Metrics, MetricsMiddleware
+
+
+def test_histogram_render_is_cumulative():
+    hist = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        hist.observe(value)
+    assert hist.render("lat", 'pid="1"') == [
+        'lat_bucket{pid="1",le="0.1"} 2',
+        'lat_bucket{pid="1",le="1.0"} 3',
+        'lat_bucket{pid="1",le="+Inf"} 4',
+        'lat_sum{pid="1"} 2.65',
+        'lat_count{pid="1"} 4',
+    ]
+    assert hist.render("lat", "")[-2:] == ["lat_sum 2.65", "lat_count 4"]
+
+
+def test_every_series_carries_the_pid():
+    metrics = Metrics(pid=42)
+    metrics.observe_request("GET", '/a"b', 200, 0.002)
+    metrics.count_bus_update("1", 3)
+    lines = [line for line in metrics.render().splitlines() if not line.startswith("#")]
+    assert lines and all('pid="42"' in line for line in lines)
+    assert 'http_requests_total{pid="42",method="GET",route="/a\\"b",status="200"} 1' in lines
+    assert 'bus_location_updates_total{pid="42",bus="1"} 3' in lines
+
+
+def call(middleware, route=None, status=200, fail=False):
+    async def app(scope, receive, send):
+        if route is not None:
+            scope["route"] = SimpleNamespace(path=route)
+        if fail:
+            raise RuntimeError("boom")
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    middleware.app = app
+    return asyncio.run(middleware({"type": "http", "method": "POST"}, None, send))
+
+
+def test_middleware_labels_by_route_template():
+    metrics = Metrics(pid=1)
+    middleware = MetricsMiddleware(None, metrics)
+    call(middleware, "/buses/{bus_id}/location", 201)
+    call(middleware, "/buses/{bus_id}/location", 201)
+    call(middleware, None, 404)
+    with pytest.raises(RuntimeError):
+        call(middleware, "/boom", fail=True)
+    assert metrics.requests == {
+        ("POST", "/buses/{bus_id}/location", 201): 2,
+        ("POST", "unmatched", 404): 1,
+        ("POST", "/boom", 500): 1,
+    }
+    assert metrics.latency[("POST", "/buses/{bus_id}/location")].count == 2
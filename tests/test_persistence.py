@@ -0,0 +1,136 @@
+import asyncio
+import os
+import struct
+import zlib
+
+from persistence import FRAME, DurableLog, encode_record
+from store import BusStore
+
+
+def fleet():
+    return {
+        "1": {"lat": 1.0, "lng": 2.0, "name": "A", "status": "inactive", "lastUpdate": None, "driver": None},
+        "2": {"lat": 3.0, "lng": 4.0, "name": "B", "status": "inactive", "lastUpdate": None, "driver": None},
+    }
+
+
+def bus(lat, driver=None):
+    return {"lat": lat, "lng": 2.0, "status": "active", "lastUpdate": "2024-01-01T00:00:00", "driver": driver}
+
+
+def write_wal(path, *chunks):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "wal.log"), "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def test_load_keeps_newest_record_per_bus(tmp_path):
+    write_wal(tmp_path, encode_record("1", 1, bus(1.0)), encode_record("2", 2, bus(2.0)),
+              encode_record("1", 3, bus(3.0, "d1")), encode_record("2", 1, bus(9.0)))
+    records, replayed = DurableLog(str(tmp_path)).load()
+    assert replayed == 4
+    assert records["1"] == (3, bus(3.0, "d1"))
+    assert records["2"][0] == 2 and records["2"][1]["lat"] == 2.0
+
+
+def test_load_truncates_torn_tail(tmp_path):
+    good = encode_record("1", 1, bus(1.0))
+    torn = encode_record("2", 2, bus(2.0))[:-5]
+    write_wal(tmp_path, good, torn)
+    records, replayed = DurableLog(str(tmp_path)).load()
+    assert list(records) == ["1"] and replayed == 1
+    assert os.path.getsize(tmp_path / "wal.log") == len(good)
+
+
+def test_load_stops_at_corrupt_frame(tmp_path):
+    first = encode_record("1", 1, bus(1.0))
+    bad = bytearray(encode_record("2", 2, bus(2.0)))
+    bad[FRAME.size + 3] ^= 0xFF
+    write_wal(tmp_path, first, bytes(bad), encode_record("1", 3, bus(3.0)))
+    records, replayed = DurableLog(str(tmp_path)).load()
+    assert records == {"1": (1, bus(1.0))} and replayed == 1
+    assert os.path.getsize(tmp_path / "wal.log") == len(first)
+
+
+def test_corrupt_snapshot_is_ignored_but_log_is_replayed(tmp_path):
+    write_wal(tmp_path, encode_record("2", 5, bus(5.0)))
+    with open(tmp_path / "snapshot.bin", "wb") as f:
+        state = b"BUSSNAP1" + struct.pack("<QI", 4, 1) + encode_record("1", 4, bus(4.0))
+        f.write(state + struct.pack("<I", zlib.crc32(state) ^ 1))
+    records, _ = DurableLog(str(tmp_path)).load()
+    assert list(records) == ["2"]
+
+
+async def _log_then_recover(data_dir):
+    store = BusStore(fleet())
+    log = DurableLog(data_dir, snapshot_records=3)
+    await log.start(store)
+    for i in range(5):
+        await store.update(str(i % 2 + 1), {"lat": float(i), "driver": f"d{i}"})
+        await log._flush()
+    await log.snapshot()
+    await store.update("1", {"lat": 42.0})
+    await log.close()
+
+    recovered = BusStore(fleet())
+    log = DurableLog(data_dir)
+    await log.start(recovered)
+    await log.close()
+    return store, recovered
+
+
+def test_snapshot_and_log_round_trip(tmp_path):
+    store, recovered = asyncio.run(_log_then_recover(str(tmp_path)))
+    for bus_id in ("1", "2"):
+        assert recovered.buses[bus_id] == store.buses[bus_id]
+        assert recovered.bus_versions[bus_id] == store.bus_versions[bus_id]
+
+
+async def _take_over(data_dir):
+    store = BusStore(fleet())
+    await store.update("1", {"lat": 7.0})
+    log = DurableLog(data_dir)
+    log.store = store
+    store.add_listener(log._on_change)
+    assert log._try_lock()
+    await log._take_over()
+    await store.update("2", {"lat": 8.0})
+    await log._flush()
+    await log.close()
+
+
+def test_take_over_cuts_torn_tail_and_snapshots(tmp_path):
+    # The previous writer died halfway through a frame
+    write_wal(tmp_path, encode_record("1", 1, bus(1.0)), encode_record("2", 2, bus(2.0))[:10])
+    asyncio.run(_take_over(str(tmp_path)))
+    records, _ = DurableLog(str(tmp_path)).load()
+    # Bus 1's unlogged change came in through the snapshot, bus 2's through the log
+    assert records["1"][1]["lat"] == 7.0
+    assert records["2"][1]["lat"] == 8.0
+
+
+async def _epoch_change(data_dir):
+    store = BusStore(fleet())
+    log = DurableLog(data_dir)
+    await log.start(store)
+    for i in range(5):
+        await store.update("1", {"lat": float(i), "driver": "old"})
+    await log._flush()
+
+    # What a pub/sub hub restart looks like: new epoch, versions from 1 again
+    store.epoch = "new"
+    store.version = 0
+    store.bus_versions = {bus_id: 0 for bus_id in store.buses}
+    await store.update("1", {"lat": 99.0, "driver": None})
+    assert not log.buffer       # not logged under the old epoch
+    await log.snapshot()
+    await store.update("2", {"lat": 42.0})
+    await log.close()
+
+
+def test_epoch_change_replaces_log_with_snapshot(tmp_path):
+    asyncio.run(_epoch_change(str(tmp_path)))
+    records, _ = DurableLog(str(tmp_path)).load()
+    assert records["1"] == (1, {**bus(99.0), "lastUpdate": None, "status": "inactive"})
+    assert records["2"][1]["lat"] == 42.0
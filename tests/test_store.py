@@ -0,0 +1,219 @@
+import asyncio
+import struct
+
+import pytest
+
+from bus_cache import BusSnapshotCache
+from store import BusStore, PubSubHub, PubSubStore, SharedMemoryStore, StoreUnavailable
+
+
+def fleet():
+    return {
+        "1": {"lat": 1.0, "lng": 2.0, "name": "A", "status": "inactive", "lastUpdate": None, "driver": None},
+        "2": {"lat": 3.0, "lng": 4.0, "name": "B", "status": "inactive", "lastUpdate": None, "driver": None},
+    }
+
+
+def record_changes(store):
+    seen = []
+    store.add_listener(lambda bus_id, version, remote, fixes: seen.append((bus_id, version, remote, list(fixes))))
+    return seen
+
+
+def test_memory_store_reports_changes_with_fixes():
+    store = BusStore(fleet())
+    seen = record_changes(store)
+    version = asyncio.run(store.update("1", {"lat": 5.0}, [(10.0, 4.0, 2.0), (11.0, 5.0, 2.0)]))
+    assert version == 1 and store.buses["1"]["lat"] == 5.0
+    assert seen == [("1", 1, False, [(10.0, 4.0, 2.0), (11.0, 5.0, 2.0)])]
+
+
+def test_shm_store_shares_state_and_fixes(tmp_path):
+    path = str(tmp_path / "state")
+    a = SharedMemoryStore(fleet(), path)
+    b = SharedMemoryStore(fleet(), path)
+    seen = record_changes(b)
+    assert a.epoch == b.epoch
+
+    asyncio.run(a.update("1", {"lat": 5.0, "status": "active"}, [(10.0, 4.0, 2.0), (11.0, 5.0, 2.0)]))
+    asyncio.run(a.update("1", {"lat": 6.0}, [(12.0, 6.0, 2.0)]))
+    asyncio.run(a.update("2", {"driver": "d2"}))
+    assert b.sync() == 2
+    assert b.buses["1"]["lat"] == 6.0 and b.buses["1"]["status"] == "active"
+    assert b.buses["2"]["driver"] == "d2"
+    assert b.version == a.version == 3
+    assert sorted(seen) == [("1", 2, True, [(10.0, 4.0, 2.0), (11.0, 5.0, 2.0), (12.0, 6.0, 2.0)]),
+                            ("2", 3, True, [])]
+    assert b.sync() == 0
+
+    # A write from b is merged onto the shared record, not b's view
+    asyncio.run(b.update("1", {"lng": 9.0}))
+    a.sync()
+    assert a.buses["1"]["lat"] == 6.0 and a.buses["1"]["lng"] == 9.0
+    asyncio.run(a.close())
+    asyncio.run(b.close())
+
+
+def test_shm_fix_ring_drops_overwritten_entries(tmp_path):
+    path = str(tmp_path / "state")
+    a = SharedMemoryStore(fleet(), path, fix_slots=4)
+    b = SharedMemoryStore(fleet(), path, fix_slots=4)
+    seen = record_changes(b)
+    asyncio.run(a.update("1", {"lat": 1.5}, [(float(t), 1.0, 2.0) for t in range(3)]))
+    asyncio.run(a.update("1", {"lat": 1.6}, [(float(t), 1.0, 2.0) for t in range(3, 6)]))
+    b.sync()
+    # Only the last four fixes survive in a four-slot ring
+    assert [f[0] for f in seen[0][3]] == [2.0, 3.0, 4.0, 5.0]
+    asyncio.run(a.update("1", {"lat": 1.7}, [(6.0, 1.0, 2.0)]))
+    b.sync()
+    assert seen[1][3] == [(6.0, 1.0, 2.0)]
+    asyncio.run(a.close())
+    asyncio.run(b.close())
+
+
+def half_write(store, bus_id, fields, fixes):
+    """An update stopped between writing the record and bumping the header."""
+    slot = store.slots[bus_id]
+    version = store._counter(store.VERSION_OFFSET) + 1
+    store._append_fixes(slot, version, fixes)
+    store._write_record(bus_id, {**store._record_fields(store._read_record(slot)), **fields}, version)
+    return version
+
+
+def commit(store, version):
+    struct.pack_into("<Q", store.mm, store.VERSION_OFFSET, version)
+
+
+def test_shm_sync_waits_for_half_written_update(tmp_path):
+    path = str(tmp_path / "state")
+    a = SharedMemoryStore(fleet(), path)
+    b = SharedMemoryStore(fleet(), path)
+    seen = record_changes(b)
+    asyncio.run(a.update("1", {"lat": 5.0}, [(1.0, 5.0, 2.0)]))
+    version = half_write(a, "2", {"lat": 6.0}, [(10.0, 6.0, 4.0), (11.0, 6.0, 4.0)])
+    b.sync()
+    assert seen == [("1", 1, True, [(1.0, 5.0, 2.0)])]
+    commit(a, version)
+    b.sync()
+    assert seen[-1] == ("2", 2, True, [(10.0, 6.0, 4.0), (11.0, 6.0, 4.0)])
+    asyncio.run(a.close())
+    asyncio.run(b.close())
+
+
+def test_shm_sync_keeps_fixes_of_a_bus_with_an_update_in_flight(tmp_path):
+    path = str(tmp_path / "state")
+    a = SharedMemoryStore(fleet(), path)
+    b = SharedMemoryStore(fleet(), path)
+    seen = record_changes(b)
+    asyncio.run(a.update("1", {"lat": 5.0}, [(1.0, 5.0, 2.0), (2.0, 5.0, 2.0)]))
+    version = half_write(a, "1", {"lat": 6.0}, [(3.0, 6.0, 2.0)])
+    b.sync()
+    assert seen == []
+    commit(a, version)
+    b.sync()
+    assert seen == [("1", 2, True, [(1.0, 5.0, 2.0), (2.0, 5.0, 2.0), (3.0, 6.0, 2.0)])]
+    asyncio.run(a.close())
+    asyncio.run(b.close())
+
+
+async def _pubsub_round_trip():
+    hub = PubSubHub()
+    server = await hub.serve("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    a = PubSubStore(fleet(), port=port)
+    b = PubSubStore(fleet(), port=port)
+    seen_a, seen_b = record_changes(a), record_changes(b)
+    await a.start()
+    await b.start()
+    try:
+        # Only an empty hub is seeded from recovered state
+        await a.restore({"2": (7, {"driver": "d2", "status": "active"})})
+        version = await a.update("1", {"lat": 5.0}, [(10.0, 4.0, 2.0), (11.0, 5.0, 2.0)])
+        for _ in range(100):
+            if b.version == version:
+                break
+            await asyncio.sleep(0.01)
+        assert version == 2
+        assert b.buses["1"]["lat"] == 5.0 and b.buses["2"]["driver"] == "d2"
+        assert seen_a[-1] == ("1", 2, False, [[10.0, 4.0, 2.0], [11.0, 5.0, 2.0]])
+        assert seen_b[-1] == ("1", 2, True, [[10.0, 4.0, 2.0], [11.0, 5.0, 2.0]])
+
+        # A worker connecting later gets the hub's state, and can't re-seed it
+        c = PubSubStore(fleet(), port=port)
+        await c.start()
+        for _ in range(100):
+            if c.version == version:
+                break
+            await asyncio.sleep(0.01)
+        assert c.buses["1"]["lat"] == 5.0 and c.epoch == a.epoch
+        await c.restore({"1": (99, {"lat": 0.0})})
+        assert c.buses["1"]["lat"] == 5.0
+        await c.close()
+    finally:
+        await a.close()
+        await b.close()
+        server.close()
+        await server.wait_closed()
+
+
+def test_pubsub_round_trip_through_hub():
+    asyncio.run(_pubsub_round_trip())
+
+
+async def wait_for(predicate):
+    for _ in range(200):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+async def _pubsub_hub_restart():
+    hub = PubSubHub()
+    server = await hub.serve("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    store = PubSubStore(fleet(), port=port)
+    cache = BusSnapshotCache(store)
+    await store.start()
+    try:
+        for i in range(5):
+            await store.update("1", {"lat": float(i)})
+        old_etag = cache.etag
+        assert store.version == 5
+
+        # The hub goes away and a fresh one (new epoch, empty state) starts
+        server.close()
+        for writer in list(hub.clients):
+            writer.close()
+        await server.wait_closed()
+        hub = PubSubHub()
+        server = await hub.serve("127.0.0.1", port)
+        await wait_for(lambda: store.epoch == hub.epoch)
+
+        await store.update("1", {"lat": 10.0})
+        await store.update("2", {"lat": 11.0})
+        assert store.version == 2 and store.bus_versions == {"1": 1, "2": 2}
+        assert cache.etag not in (old_etag, f'"{hub.epoch}-5"')
+        assert b'"lat":11.0' in cache.body()[0]
+        assert set(cache.changed_since(old_etag)) == {"1", "2"}
+    finally:
+        await store.close()
+        server.close()
+        await server.wait_closed()
+
+
+def test_pubsub_versions_restart_with_the_hub():
+    asyncio.run(_pubsub_hub_restart())
+
+
+async def _pubsub_hub_down():
+    store = PubSubStore(fleet(), port=1, timeout=0.2)
+    try:
+        await store.update("1", {"lat": 5.0})
+    finally:
+        await store.close()
+
+
+def test_pubsub_update_fails_when_hub_is_down():
+    with pytest.raises(StoreUnavailable):
+        asyncio.run(_pubsub_hub_down())